@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import time
+from collections import deque
+
+################################################################################
+#
+#   Incrementally maintained statistics over the condition stream, published
+#   as additional device states (daily high/low, peak gust, pressure change).
+#
+################################################################################
+
+kToday = 0      # window that resets at local midnight
+
+# (derived state, source states, window in seconds or kToday, statistic)
+# Derived values are converted and formatted like the first source state, so 'change' is only used for states without an offset conversion.
+kDerivedStates = [
+    ('temp_hi_today',               ['temp'],                                           kToday,     'max'),
+    ('temp_lo_today',               ['temp'],                                           kToday,     'min'),
+    ('temp_avg_last_1_hr',          ['temp'],                                           3600,       'mean'),
+    ('hum_hi_today',                ['hum'],                                            kToday,     'max'),
+    ('hum_lo_today',                ['hum'],                                            kToday,     'min'),
+    ('wind_speed_hi_last_1_hr',     ['wind_speed_last', 'wind_speed_hi_last_2_min'],    3600,       'max'),
+    ('wind_speed_hi_today',         ['wind_speed_last', 'wind_speed_hi_last_2_min'],    kToday,     'max'),
+    ('bar_sea_level_hi_today',      ['bar_sea_level'],                                  kToday,     'max'),
+    ('bar_sea_level_lo_today',      ['bar_sea_level'],                                  kToday,     'min'),
+    ('bar_change_last_3_hr',        ['bar_sea_level'],                                  3 * 3600,   'change'),
+]
+
+
+class RollingWindow(object):
+    # Samples from the last 'seconds'; min/max come from monotonic deques, mean from a running total
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()      # (ts, value) in arrival order
+        self.maxima = deque()       # (ts, value) with decreasing values, head is the window max
+        self.minima = deque()       # (ts, value) with increasing values, head is the window min
+        self.total = 0.0
+
+    def add(self, ts, value):
+        self.samples.append((ts, value))
+        self.total += value
+
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((ts, value))
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((ts, value))
+
+        cutoff = ts - self.seconds
+        while self.samples[0][0] < cutoff:
+            self.total -= self.samples.popleft()[1]
+        while self.maxima[0][0] < cutoff:
+            self.maxima.popleft()
+        while self.minima[0][0] < cutoff:
+            self.minima.popleft()
+
+    def value(self, statistic):
+        if statistic == 'max':
+            return self.maxima[0][1]
+        elif statistic == 'min':
+            return self.minima[0][1]
+        elif statistic == 'mean':
+            return self.total / len(self.samples)
+        elif statistic == 'change':
+            return self.samples[-1][1] - self.samples[0][1]
+
+
+class DailyWindow(object):
+    # Statistics since local midnight, no samples need to be kept
+
+    def __init__(self):
+        self.next_reset = 0.0
+
+    def add(self, ts, value):
+        if ts >= self.next_reset:
+            today = time.localtime(ts)
+            self.next_reset = time.mktime((today.tm_year, today.tm_mon, today.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+            self.first = self.low = self.high = value
+            self.total = 0.0
+            self.count = 0
+
+        self.last = value
+        self.total += value
+        self.count += 1
+        if value < self.low:
+            self.low = value
+        if value > self.high:
+            self.high = value
+
+    def value(self, statistic):
+        if statistic == 'max':
+            return self.high
+        elif statistic == 'min':
+            return self.low
+        elif statistic == 'mean':
+            return self.total / self.count
+        elif statistic == 'change':
+            return self.last - self.first
+
+
+class AggregateEngine(object):
+
+    def __init__(self):
+        self.windows = {}           # RollingWindow or DailyWindow, indexed by (lsid, derived state)
+
+    def update(self, lsid, condition, ts):
+        # Feed one raw condition, returns [(derived state, source state, raw value)] for the states it affects
+
+        results = []
+        for derivedKey, sourceKeys, seconds, statistic in kDerivedStates:
+            values = [condition[key] for key in sourceKeys if isinstance(condition.get(key), (int, float))]
+            if not values:
+                continue
+
+            window = self.windows.get((lsid, derivedKey))
+            if window is None:
+                window = DailyWindow() if seconds == kToday else RollingWindow(seconds)
+                self.windows[(lsid, derivedKey)] = window
+
+            for value in values:
+                window.add(ts, value)
+            results.append((derivedKey, sourceKeys[0], window.value(statistic)))
+        return results
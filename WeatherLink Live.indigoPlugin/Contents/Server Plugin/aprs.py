@@ -29,9 +29,130 @@ import indigo
 
 import logging
 import time
+import socket
+import threading
 
 from datetime import datetime
-from socket import socket, AF_INET, SOCK_STREAM
+
+kUploadTimeout = 15.0       # seconds allowed for each APRS-IS socket operation
+kKeepaliveInterval = 120.0  # seconds of idle time before sending a keepalive comment
+kMinBackoff = 5.0           # first reconnect delay after a failed connection
+kMaxBackoff = 300.0         # longest reconnect delay
+kBackfillAge = 30 * 60.0    # seconds a packet that couldn't be sent is kept, CWOP ignores older observations
+
+
+class APRSClient(object):
+    # Long-lived APRS-IS connection, shared by successive uploads from one sender
+
+    def __init__(self, name, host, port, login):
+        self.logger = logging.getLogger("Plugin.APRSClient")
+        self.name = name
+        self.host = host
+        self.port = port
+        self.login = login
+        
+        self.sock = None
+        self.lock = threading.Lock()    # serializes connect/send/close between upload and monitor threads
+        self.backoff = 0.0
+        self.next_connect = 0.0
+        self.last_send = 0.0
+
+
+    def connect(self):
+        # Called with self.lock held
+
+        if time.time() < self.next_connect:
+            raise socket.error("reconnect delayed for {:.0f} seconds".format(self.next_connect - time.time()))
+            
+        sock = None
+        try:
+            sock = socket.create_connection((self.host, self.port), kUploadTimeout)
+            sock.sendall(self.login)
+
+            # wait for the server to acknowledge the login instead of sleeping
+            reader = sock.makefile('rb')
+            while True:
+                line = reader.readline()
+                if not line:
+                    raise socket.error("connection closed during login")
+                if line.startswith('# logresp'):
+                    break
+            reader.close()
+            
+        except (socket.error, socket.timeout):
+            if sock:
+                sock.close()
+            self.backoff = min(max(self.backoff * 2, kMinBackoff), kMaxBackoff)
+            self.next_connect = time.time() + self.backoff
+            raise
+
+        self.logger.debug(u"{}: APRS-IS connected: {}".format(self.name, line.strip()))
+        self.backoff = 0.0
+        self.sock = sock
+        self.last_send = time.time()
+
+        monitor = threading.Thread(target=self.monitor, args=(sock,), name="aprs-monitor")
+        monitor.daemon = True
+        monitor.start()
+
+
+    def send(self, packet):
+        with self.lock:
+            if not self.sock:
+                self.connect()
+            try:
+                self.sock.sendall(packet)
+            except (socket.error, socket.timeout) as err:
+                # connection went stale between uploads, try once more on a fresh one
+                self.logger.debug(u"{}: APRS-IS send failed, reconnecting: {}".format(self.name, err))
+                self.disconnect()
+                self.connect()
+                self.sock.sendall(packet)
+            self.last_send = time.time()
+
+
+    def disconnect(self):
+        # Called with self.lock held
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+
+    def monitor(self, sock):
+        # Drains the server's comment lines, sends keepalives when idle and notices a dropped connection
+        
+        while self.sock is sock:
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                data = None
+            except socket.error:
+                data = ''
+
+            with self.lock:
+                if self.sock is not sock:
+                    return
+                if data == '':
+                    self.logger.debug(u"{}: APRS-IS connection closed by server".format(self.name))
+                    self.disconnect()
+                    return
+                if time.time() - self.last_send > kKeepaliveInterval:
+                    try:
+                        sock.sendall('#keepalive\r\n')
+                        self.last_send = time.time()
+                    except (socket.error, socket.timeout):
+                        self.disconnect()
+                        return
+
 
 class APRS(object):
 
@@ -50,6 +171,8 @@ class APRS(object):
 
         self.updateFrequency = (float(self.device.pluginProps.get('updateFrequency', "10")) *  60.0)
         self.next_update = time.time()
+        self.upload_pending = False
+        self.backfill_age = kBackfillAge
 
         self.logger.debug(u"{}: APRS station_id = {}, server_host = {}, server_port = {}".format(self.device.name, self.address, self.server_host, self.server_port))
 
@@ -57,6 +180,9 @@ class APRS(object):
         self.position = "{}/{}".format(self.convert_latitude(latitude), self.convert_longitude(longitude))
         self.logger.debug(u"{}: self.position = {}".format(self.device.name, self.position))
 
+        login = 'user {} pass -1 vers Indigo-aprs.py\r\n'.format(self.address)
+        self.client = APRSClient(self.device.name, self.server_host, int(self.server_port), login.encode('utf-8'))
+
         stateList = [
             { 'key':'status',   'value':  "Started"},
             { 'key':'timestamp','value':  datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
@@ -66,6 +192,7 @@ class APRS(object):
 
 
     def __del__(self):
+        self.client.close()
         stateList = [
             { 'key':'status',   'value':  "Off"},
             { 'key':'timestamp','value':  datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
@@ -117,66 +244,59 @@ class APRS(object):
         return lon
 
 
-    def send_update(self):
+    def start_update(self, readings):
+        # Runs on the concurrent thread, returns the packet for send_update.  readings are from ConditionSnapshot, in US units.
 
         self.logger.info(u"{}: Sending Update".format(self.device.name))
 
         self.next_update = time.time() + self.updateFrequency
+        self.upload_pending = True
     
-        iss_device = indigo.devices[self.iss_device]
-        baro_device = indigo.devices[self.baro_device]
-
-        wind_dir = int(iss_device.states['wind_dir_scalar_avg_last_10_min'])
-        wind_speed = int(iss_device.states['wind_speed_avg_last_10_min'])
-        wind_gust = int(iss_device.states['wind_speed_hi_last_10_min'])
-        temperature = float(iss_device.states['temp'])
-        rain_60_min = float(iss_device.states['rain_60_min']) * 100.0
-        rain_24_hr = float(iss_device.states['rain_24_hr']) * 100.0
-        rainfall_daily = float(iss_device.states['rainfall_daily']) * 100.0
-        humidity = int(iss_device.states['hum'])
-        pressure = (float(baro_device.states['bar_sea_level'])/ 0.029530) * 10
+        wind_dir = int(readings['wind_dir_scalar_avg_last_10_min'])
+        wind_speed = int(readings['wind_speed_avg_last_10_min'])
+        wind_gust = int(readings['wind_speed_hi_last_10_min'])
+        temperature = readings['temp']
+        rain_60_min = readings['rain_60_min'] * 100.0
+        rain_24_hr = readings['rain_24_hr'] * 100.0
+        rainfall_daily = readings['rainfall_daily'] * 100.0
+        humidity = int(readings['hum'])
+        pressure = (readings['bar_sea_level'] / 0.029530) * 10
 
         wx_data = '{:03d}/{:03d}g{:03d}t{:03.0f}r{:03.0f}p{:03.0f}P{:03.0f}h{:02d}b{:05.0f}'.format(
             wind_dir, wind_speed, wind_gust, temperature, rain_60_min, rain_24_hr, rainfall_daily, humidity, pressure)
-        self.logger.debug(u"{}: wx_data = {}".format(self.device.name, wx_data))
+        self.logger.debug(u"%s: wx_data = %s", self.device.name, wx_data)
     
         utc_s = datetime.now().strftime("%d%H%M")
 
-        packet_data = '{}>APRS,TCPIP*:@{}z{}_{}Indigo WeatherLink Live\r\n'.format(self.address, utc_s, self.position, wx_data)
+        return '{}>APRS,TCPIP*:@{}z{}_{}Indigo WeatherLink Live\r\n'.format(self.address, utc_s, self.position, wx_data)
         
-        try:
-            # Create socket and connect to server
-            sSock = socket(AF_INET, SOCK_STREAM)
-            sSock.connect((self.server_host, int(self.server_port)))
-
-            # Log on
-            login = 'user {} pass -1 vers Indigo-aprs.py\r\n'.format(self.address)
-            sSock.send(login.encode('utf-8'))
-            time.sleep(2)
-
-            # Send packet
-            sSock.send(packet_data.encode('utf-8'))
-            time.sleep(2)
-
-            # Close socket, must be closed to avoid buffer overflow
-            sSock.shutdown(0)
-            sSock.close()
 
+    def send_update(self, packet_data):
+        # Runs on an upload worker thread, returns the resulting status
+        
+        try:
+            self.client.send(packet_data.encode('utf-8'))
         except Exception as err:
             self.logger.error(u"{}: send_update error: {}".format(self.device.name, err))
-            status = "Send Error"
-            stateImage = indigo.kStateImageSel.SensorTripped
+            return "Send Error"
             
-        else:
-            self.logger.debug(u"{}: send_update complete".format(self.device.name))
-            status = "OK"
+        self.logger.debug(u"%s: send_update complete", self.device.name)
+        return "OK"
+
+
+    def send_complete(self, status):
+        # Runs on the concurrent thread
+
+        self.upload_pending = False
+        if status == "OK":
             stateImage = indigo.kStateImageSel.SensorOn
+        else:
+            stateImage = indigo.kStateImageSel.SensorTripped
 
         stateList = [
-            { 'key':'status',   'value':  status},
+            { 'key':'status',   'value':  status or "Send Error"},
             { 'key':'timestamp','value':  datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
         ]
         self.device.updateStatesOnServer(stateList)
         self.device.updateStateImageOnServer(stateImage)
   
-
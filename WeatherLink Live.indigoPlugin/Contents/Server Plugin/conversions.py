@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import time
+
+################################################################################
+#
+#   Table of state conversions, built once per unit selection so that converting
+#   a WLL condition is a single dict lookup per key.  Each conversion returns
+#   (value, uiValue, decimalPlaces) for the reading.
+#
+################################################################################
+
+# values to convert rain counts to actual units, indexed by rain_size
+kRainCollector = {  0: (None, None),
+                    1: (0.01,  "in"),
+                    2: (0.2,   "mm"),
+                    3: (0.1,   "mm"),
+                    4: (0.001, "in")
+}
+
+# consolidate redundant states (same info from http and udp with different names)
+kRenamedStates = {
+    "rainfall_last_15_min": "rain_15_min",
+    "rainfall_last_60_min": "rain_60_min",
+    "rainfall_last_24_hr":  "rain_24_hr"
+}
+
+kTemperatureStates = ['temp','temp_in', 'dew_point', 'dew_point_in', 'heat_index_in', 'wind_chill', 'wet_bulb', 'heat_index', 'thw_index', 'thsw_index',
+                      'temp_1','temp_2', 'temp_3', 'temp_4']
+kHumidityStates = ['hum', 'hum_in']
+kPressureStates = ['bar_sea_level', 'bar_trend', 'bar_absolute']
+kWindSpeedStates = ['wind_speed_last', 'wind_speed_avg_last_1_min', 'wind_speed_avg_last_2_min', 'wind_speed_hi_last_2_min',
+                    'wind_speed_avg_last_10_min', 'wind_speed_hi_last_10_min']
+kWindDirectionStates = ['wind_dir_last', 'wind_dir_scalar_avg_last_1_min', 'wind_dir_scalar_avg_last_2_min', 'wind_dir_at_hi_speed_last_2_min',
+                        'wind_dir_scalar_avg_last_10_min', 'wind_dir_at_hi_speed_last_10_min']
+kTimeStates = ['rain_storm_start_at', 'rain_storm_last_end_at', 'rain_storm_last_start_at', 'timestamp']
+kRainRateStates = ['rain_rate_last', 'rain_rate_hi', 'rain_rate_hi_last_15_min', 'rain_storm_last']
+kRainStates = ['rain_15_min', 'rain_60_min', 'rain_24_hr', 'rain_storm', 'rainfall_daily', 'rainfall_monthly', 'rainfall_year']
+
+# (scale, offset, label) for each user selectable unit, applied as (value + offset) * scale
+kNoConversion = (None, None, u"")
+
+kTemperatureUnits = {
+    "F":    (None, None, u"°F"),
+    "C":    (5.0 / 9.0, -32.0, u"°C")
+}
+kPressureUnits = {
+    "IN":   (None, None, u"in"),
+    "MM":   (25.4, 0.0, u"mm"),
+    "MB":   (33.8639, 0.0, u"mb"),
+    "HP":   (33.8639, 0.0, u"hPa")
+}
+kWindUnits = {
+    "MPH":  (None, None, u"mph"),
+    "KNO":  (0.868976, 0.0, u"knots"),
+    "KPH":  (1.60934, 0.0, u"km/h"),
+    "MPS":  (0.44704, 0.0, u"m/s")
+}
+
+
+def scaledConversion(units, decimalPlaces, uiFormat):
+    scale, offset, label = units
+    uiFormat = uiFormat.replace(u"{label}", label)
+
+    if scale is None:
+        def conversion(value, rain):
+            return value, uiFormat.format(value), decimalPlaces
+    else:
+        def conversion(value, rain):
+            value = (value + offset) * scale
+            return value, uiFormat.format(value), decimalPlaces
+    return conversion
+
+
+def rainConversion(uiFormat):
+    def conversion(value, rain):
+        factor, units = rain
+        value = float(value) * factor
+        return value, uiFormat.format(value, units), 2
+    return conversion
+
+
+def timeConversion(value, rain):
+    time_string = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime(float(value)))
+    return time_string, time_string, 0
+
+
+def buildConversionTable(units_temperature, units_barometric_pressure, units_wind):
+
+    temperature = scaledConversion(kTemperatureUnits.get(units_temperature, kTemperatureUnits["F"]), 1, u'{:.1f} {label}')
+    humidity = scaledConversion(kNoConversion, 0, u'{:.0f}%')
+    pressure = scaledConversion(kPressureUnits.get(units_barometric_pressure, kPressureUnits["IN"]), 2, u'{:.2f} {label}')
+    wind_speed = scaledConversion(kWindUnits.get(units_wind, kWindUnits["MPH"]), 0, u'{:.0f} {label}')
+    wind_direction = scaledConversion(kNoConversion, 0, u'{:d}°')
+    rain_rate = rainConversion(u'{:.2f} {}/hr')
+    rain = rainConversion(u'{:.2f} {}')
+
+    table = {}
+    for keys, conversion in [(kTemperatureStates, temperature), (kHumidityStates, humidity), (kPressureStates, pressure),
+                             (kWindSpeedStates, wind_speed), (kWindDirectionStates, wind_direction), (kTimeStates, timeConversion),
+                             (kRainStates, rain), (kRainRateStates, rain_rate)]:
+        for key in keys:
+            table[key] = conversion
+    return table
@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+################################################################################
+#
+#   JSON decoding for WeatherLink payloads, using the fastest library that is
+#   installed.  All of them take the raw UTF-8 bytes from the socket or HTTP
+#   response directly, so no intermediate unicode string is built.
+#
+################################################################################
+
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+
+    kBackend = "orjson"
+
+except ImportError:
+    try:
+        import ujson
+
+        def loads(data):
+            return ujson.loads(data, precise_float=True)   # match the stdlib's float parsing
+
+        kBackend = "ujson"
+
+    except ImportError:
+        import json
+
+        def loads(data):
+            return json.loads(data)
+
+        kBackend = "json"
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import time
+import sqlite3
+import threading
+import logging
+from itertools import izip
+
+################################################################################
+#
+#   Append-only history of converted sensor readings, kept in a SQLite database
+#   in WAL mode so queries can run while the concurrent thread is writing.
+#   Each (lsid, state) pair is a series; readings are (series, ts, value) rows
+#   clustered by series and time, so range queries are a single index scan.
+#   Readings are kept to the second; a later reading in the same second as
+#   the last one stored for its series is dropped, from the rollups as well.
+#   Five minute count/sum/min/max rollups are kept alongside, so downsampled
+#   queries over long ranges don't have to read every raw reading.
+#
+################################################################################
+
+kSchema = [
+    "CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, lsid TEXT NOT NULL, key TEXT NOT NULL, UNIQUE (lsid, key))",
+    "CREATE TABLE IF NOT EXISTS readings (series INTEGER NOT NULL, ts INTEGER NOT NULL, value REAL, PRIMARY KEY (series, ts)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS rollups (series INTEGER NOT NULL, ts INTEGER NOT NULL, count INTEGER, total REAL, low REAL, high REAL, "
+        "PRIMARY KEY (series, ts)) WITHOUT ROWID"
+]
+
+kPruneInterval = 6 * 60 * 60     # seconds between removals of expired readings
+kRollupInterval = 5 * 60         # seconds covered by each rollup row
+
+
+class HistoryStore(object):
+
+    def __init__(self, path, retentionDays):
+        self.logger = logging.getLogger("Plugin.HistoryStore")
+        self.path = path
+        self.retention = retentionDays * 24 * 60 * 60
+        self.next_prune = 0.0
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in kSchema:
+            self.db.execute(statement)
+        self.db.commit()
+
+        self.seriesIds = dict(((lsid, key), seriesId) for seriesId, lsid, key in self.db.execute("SELECT id, lsid, key FROM series"))
+        self.pending = []           # (series, ts, value) rows waiting for the next flush
+        self.lastTs = {}            # ts of the last reading queued, indexed by series
+        self.rollups = {}           # [ts, count, total, low, high] of the open rollup, indexed by series
+        self.pendingRollups = []    # (series, ts, count, total, low, high) rows of closed rollups waiting for the next flush
+
+        self.logger.debug(u"HistoryStore opened {}, {} series, retention {} days".format(path, len(self.seriesIds), retentionDays))
+
+    def close(self):
+        with self.lock:
+            self.pendingRollups.extend([tuple([seriesId] + rollup) for seriesId, rollup in self.rollups.items()])
+            self.rollups = {}
+            self.flushLocked()
+            self.db.close()
+
+    def seriesId(self, lsid, key):
+        seriesId = self.seriesIds.get((lsid, key))
+        if seriesId is None:
+            seriesId = self.db.execute("INSERT INTO series (lsid, key) VALUES (?, ?)", (lsid, key)).lastrowid
+            self.seriesIds[(lsid, key)] = seriesId
+        return seriesId
+
+    def record(self, lsid, record, ts):
+        # Queue the numeric states of one converted condition (a StateRecord); flush() writes them
+        ts = int(ts)
+        with self.lock:
+            for key, value in izip(record.keys, record.values):
+                if isinstance(value, (int, float)):
+                    seriesId = self.seriesId(lsid, key)
+                    if self.lastTs.get(seriesId) == ts:
+                        continue        # readings are kept to the second, only the first in each second is stored and rolled up
+                    self.lastTs[seriesId] = ts
+                    self.pending.append((seriesId, ts, value))
+                    self.rollup(seriesId, ts, value)
+
+    def rollup(self, seriesId, ts, value):
+        bucket = ts - ts % kRollupInterval
+        rollup = self.rollups.get(seriesId)
+        if rollup is None or rollup[0] != bucket:
+            if rollup:
+                self.pendingRollups.append(tuple([seriesId] + rollup))
+            # pick up a partial rollup written by a previous run
+            row = self.db.execute("SELECT count, total, low, high FROM rollups WHERE series = ? AND ts = ?", (seriesId, bucket)).fetchone()
+            rollup = [bucket] + list(row) if row else [bucket, 0, 0.0, value, value]
+            self.rollups[seriesId] = rollup
+
+        rollup[1] += 1
+        rollup[2] += value
+        if value < rollup[3]:
+            rollup[3] = value
+        if value > rollup[4]:
+            rollup[4] = value
+
+    def flush(self):
+        with self.lock:
+            self.flushLocked()
+
+    def flushLocked(self):
+        if self.pending:
+            self.db.executemany("INSERT OR IGNORE INTO readings (series, ts, value) VALUES (?, ?, ?)", self.pending)
+            self.pending = []
+        if self.pendingRollups:
+            self.db.executemany("INSERT OR REPLACE INTO rollups (series, ts, count, total, low, high) VALUES (?, ?, ?, ?, ?, ?)", self.pendingRollups)
+            self.pendingRollups = []
+        self.db.commit()
+
+        if time.time() > self.next_prune:
+            self.next_prune = time.time() + kPruneInterval
+            self.prune(int(time.time() - self.retention))
+
+    def prune(self, expired):
+        # One series at a time, so each delete is a range scan of the (series, ts) primary key rather than a full scan
+        began = time.time()
+        pruned = 0
+        for seriesId in self.seriesIds.values():
+            pruned += self.db.execute("DELETE FROM readings WHERE series = ? AND ts < ?", (seriesId, expired)).rowcount
+            self.db.execute("DELETE FROM rollups WHERE series = ? AND ts < ?", (seriesId, expired))
+        self.db.commit()
+        self.logger.debug(u"HistoryStore pruned {} expired readings from {} series in {:.3f} sec".format(pruned, len(self.seriesIds), time.time() - began))
+
+    def query(self, lsid, key, start, end, interval=0):
+        # Returns [ts, value] rows, or [bucket ts, avg, min, max] rows when downsampling to interval seconds.
+        # Intervals that are whole multiples of the rollup interval are answered from the rollups, which
+        # don't include the currently open rollup.  Uses its own connection so it can run on any thread
+        # while the writer is busy.
+
+        db = sqlite3.connect(self.path)
+        try:
+            row = db.execute("SELECT id FROM series WHERE lsid = ? AND key = ?", (lsid, key)).fetchone()
+            if not row:
+                return []
+            if interval and interval % kRollupInterval == 0:
+                cursor = db.execute("SELECT (ts / ?) * ? AS bucket, SUM(total) / SUM(count), MIN(low), MAX(high) FROM rollups "
+                                    "WHERE series = ? AND ts BETWEEN ? AND ? GROUP BY bucket ORDER BY bucket",
+                                    (int(interval), int(interval), row[0], int(start), int(end)))
+            elif interval:
+                cursor = db.execute("SELECT (ts / ?) * ? AS bucket, AVG(value), MIN(value), MAX(value) FROM readings "
+                                    "WHERE series = ? AND ts BETWEEN ? AND ? GROUP BY bucket ORDER BY bucket",
+                                    (int(interval), int(interval), row[0], int(start), int(end)))
+            else:
+                cursor = db.execute("SELECT ts, value FROM readings WHERE series = ? AND ts BETWEEN ? AND ? ORDER BY ts",
+                                    (row[0], int(start), int(end)))
+            return [list(result) for result in cursor]
+        finally:
+            db.close()
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import time
+import socket
+import errno
+import logging
+
+import decoder
+
+################################################################################
+#
+#   One shared UDP socket per broadcast port.  Every WeatherLink Live on the
+#   network broadcasts to the same port, so each datagram is received and
+#   decoded once here and then routed to the owning WeatherLink by the plugin.
+#
+################################################################################
+
+class UDPListener(object):
+
+    def __init__(self, port, perfStats):
+        self.logger = logging.getLogger("Plugin.UDPListener")
+        self.port = port
+        self.name = u"port {}".format(port)
+        self.perfStats = perfStats
+        self.sock = None
+
+    def start(self):
+
+        if self.sock:
+            return True
+
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.sock.setblocking(0)
+            self.sock.bind(('', self.port))
+        except socket.error as err:
+            self.logger.error(u"UDPListener start error on port {}: {}".format(self.port, err))
+            self.sock = None
+            return False
+
+        self.logger.debug(u"UDPListener started on port {}".format(self.port))
+        return True
+
+    def stop(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            self.logger.debug(u"UDPListener stopped on port {}".format(self.port))
+
+    def receive(self):
+        # Returns (sender address, decoded json or None if undecodable), or None once the socket is drained
+
+        if not self.sock:
+            return None
+
+        try:
+            data, addr = self.sock.recvfrom(2048)
+        except socket.error, err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.logger.error(u"UDPListener receive error on port {}: {}".format(self.port, err))
+            return None
+
+        began = time.time()
+        try:
+            self.logger.threaddebug("%s", data)
+            json_data = decoder.loads(data)
+        except Exception as err:
+            self.logger.error(u"UDPListener JSON decode error from {}: {}".format(addr[0], err))
+            return addr[0], None
+        finally:
+            self.perfStats.record('json_decode', self.name, time.time() - began)
+
+        return addr[0], json_data
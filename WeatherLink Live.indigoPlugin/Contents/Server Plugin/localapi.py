@@ -0,0 +1,206 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import json
+import Queue
+import binascii
+import urlparse
+import threading
+import logging
+import SocketServer
+import BaseHTTPServer
+
+################################################################################
+#
+#   Local HTTP server republishing the conditions the plugin has already
+#   received, so other consumers don't each poll the WeatherLink Live.
+#
+#   GET /v1/current_conditions[?did=...] returns the latest merged conditions
+#   in the WLL's own format, with an ETag so unchanged polls get a 304.  The
+#   ETag includes a nonce picked when the server starts, so a client holding
+#   one from before a plugin restart can't match the restarted counter.
+#   GET /v1/stream is a Server-Sent Events stream with one event per HTTP poll
+#   or UDP broadcast, as they arrive.
+#
+#   publish() runs on the concurrent thread and only merges and queues, the
+#   requests are answered on the server's own threads.
+#
+################################################################################
+
+kKeepAlive = 15.0           # seconds between SSE comments on an idle stream, so proxies don't close it
+kStreamBacklog = 100        # events queued per stream subscriber before it's considered stalled and dropped
+
+
+class StationConditions(object):
+    # Latest conditions from one WeatherLink Live, merged by lsid since broadcasts only carry some of the fields
+
+    def __init__(self, did, nonce):
+        self.did = did
+        self.nonce = nonce
+        self.ts = None
+        self.conditions = {}        # merged condition dicts, indexed by lsid
+        self.version = 0
+        self.body = None            # encoded response for this version, built on the first request
+
+    def etag(self):
+        return '"{}-{}-{}"'.format(self.did, self.nonce, self.version)
+
+
+class ConditionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        self.server.api.logger.threaddebug(u"LocalAPI %s: %s", self.client_address[0], format % args)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/v1/current_conditions":
+            self.currentConditions(dict(urlparse.parse_qsl(url.query)).get('did'))
+        elif url.path == "/v1/stream":
+            self.stream()
+        else:
+            self.sendBody(404, json.dumps({"data": None, "error": {"code": 404, "message": "Not Found"}}))
+
+    def sendBody(self, code, body, etag=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def currentConditions(self, did):
+        body, etag = self.server.api.current(did)
+        if body is None:
+            self.sendBody(503, json.dumps({"data": None, "error": {"code": 503, "message": "No conditions received yet"}}))
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.sendBody(200, body, etag)
+
+    def stream(self):
+        events = self.server.api.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            while True:
+                try:
+                    event = events.get(timeout=kKeepAlive)
+                except Queue.Empty:
+                    event = ": keepalive\n\n"
+                if event is None:
+                    return
+                self.wfile.write(event)
+                self.wfile.flush()
+        except Exception as err:
+            self.server.api.logger.threaddebug(u"LocalAPI stream to %s closed: %s", self.client_address[0], err)
+        finally:
+            self.server.api.unsubscribe(events)
+
+
+class ConditionHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalAPI(object):
+
+    def __init__(self, port):
+        self.logger = logging.getLogger("Plugin.LocalAPI")
+        self.port = port
+        self.lock = threading.Lock()
+        self.nonce = binascii.hexlify(os.urandom(4))    # distinguishes this server's ETags from an earlier one's
+        self.stations = {}          # StationConditions, indexed by did
+        self.latest = None          # did of the station that reported most recently
+        self.subscribers = []       # event queues of the open streams
+
+        self.server = ConditionHTTPServer(('', port), ConditionHandler)
+        self.server.api = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name="localapi")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info(u"Local API listening on port {}".format(port))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for events in self.subscribers:
+                self.endStream(events)
+            self.subscribers = []
+        self.logger.debug(u"LocalAPI stopped on port {}".format(self.port))
+
+    def publish(self, did, ts, conditions, source):
+        # Runs on the concurrent thread for every HTTP poll ('http') and UDP broadcast ('udp')
+
+        with self.lock:
+            station = self.stations.get(did)
+            if station is None:
+                station = self.stations[did] = StationConditions(did, self.nonce)
+            for condition in conditions:
+                merged = station.conditions.get(condition['lsid'])
+                if merged is None:
+                    station.conditions[condition['lsid']] = dict(condition)
+                else:
+                    merged.update(condition)
+            station.ts = ts
+            station.version += 1
+            station.body = None
+            self.latest = did
+
+            if not self.subscribers:
+                return
+            event = "event: {}\ndata: {}\n\n".format(source, json.dumps({"did": did, "ts": ts, "conditions": conditions}))
+            stalled = []
+            for events in self.subscribers:
+                try:
+                    events.put_nowait(event)
+                except Queue.Full:
+                    stalled.append(events)
+            for events in stalled:
+                self.logger.debug(u"LocalAPI dropping stalled stream subscriber")
+                self.subscribers.remove(events)
+                self.endStream(events)
+
+    def current(self, did=None):
+        # Returns (encoded response, etag) for the station, or the one that reported most recently, or (None, None)
+
+        with self.lock:
+            station = self.stations.get(did or self.latest)
+            if station is None:
+                return None, None
+            if station.body is None:
+                station.body = json.dumps({"data": {"did": station.did, "ts": station.ts,
+                                                    "conditions": station.conditions.values()}, "error": None})
+            return station.body, station.etag()
+
+    def subscribe(self):
+        events = Queue.Queue(kStreamBacklog)
+        with self.lock:
+            self.subscribers.append(events)
+        self.logger.debug(u"LocalAPI stream subscriber added, {} open".format(len(self.subscribers)))
+        return events
+
+    def endStream(self, events):
+        # Discards anything still queued and tells the stream's handler thread to finish
+        with events.mutex:
+            events.queue.clear()
+        events.put_nowait(None)
+
+    def unsubscribe(self, events):
+        with self.lock:
+            if events in self.subscribers:
+                self.subscribers.remove(events)
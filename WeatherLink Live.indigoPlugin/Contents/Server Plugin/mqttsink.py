@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import json
+import logging
+import threading
+
+try:
+    import paho.mqtt.client as paho
+except ImportError:
+    paho = None
+
+################################################################################
+#
+#   MQTT output for the raw condition stream, as retained messages so new
+#   subscribers get the latest values straight away.  Either one topic per
+#   reading (<prefix>/<lsid>/<key>) or one JSON document per sensor
+#   (<prefix>/<lsid>).  Only readings that changed since they were last
+#   published are sent.
+#
+#   paho-mqtt keeps the connection open and reconnects on its own network
+#   thread.  paho only bounds its QoS 1/2 queue, so the sink counts every
+#   message handed to paho until on_publish() confirms it was written (QoS 0)
+#   or acknowledged (QoS 1/2), and stops publishing at kQueueLimit.  A slow or
+#   unreachable broker costs dropped messages rather than memory; a reading
+#   that couldn't be queued is forgotten, so it's sent again with the next
+#   packet.
+#
+################################################################################
+
+kKeepAlive = 60             # seconds between MQTT pings on an idle connection
+kMaxReconnect = 120         # longest delay between reconnect attempts, in seconds
+kQueueLimit = 1000          # outbound messages held while the broker is slow or unreachable
+
+
+class MQTTSink(object):
+
+    def __init__(self, host, port, prefix, qos, format, username, password, perfStats):
+        self.logger = logging.getLogger("Plugin.MQTTSink")
+        self.host = host
+        self.port = port
+        self.prefix = prefix.rstrip("/")
+        self.qos = qos
+        self.format = format
+        self.perfStats = perfStats
+        self.published = {}         # last value published, indexed by lsid then key
+        self.unsent = set()         # lsids whose last JSON document couldn't be queued
+        self.name = u"{}:{}".format(host, port)
+        self.lock = threading.Lock()
+        self.inflight = 0           # messages handed to paho and not yet published
+
+        self.client = paho.Client()
+        if username:
+            self.client.username_pw_set(username, password or None)
+        self.client.max_queued_messages_set(kQueueLimit)
+        self.client.reconnect_delay_set(1, kMaxReconnect)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.connect_async(host, port, kKeepAlive)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.logger.debug(u"MQTTSink disconnected from {}".format(self.name))
+
+    def on_connect(self, client, userdata, flags, rc):
+        # Runs on the paho network thread
+        if rc == 0:
+            self.logger.info(u"MQTT connected to {}".format(self.name))
+        else:
+            self.logger.error(u"MQTT connection to {} refused: {}".format(self.name, paho.connack_string(rc)))
+
+    def on_disconnect(self, client, userdata, rc):
+        # Runs on the paho network thread
+        if rc != 0:
+            self.logger.warning(u"MQTT connection to {} lost, reconnecting".format(self.name))
+        if self.qos == 0:
+            # paho discards unwritten QoS 0 messages when it reconnects, without calling on_publish()
+            with self.lock:
+                self.inflight = 0
+
+    def on_publish(self, client, userdata, mid):
+        # Runs on the paho network thread
+        with self.lock:
+            if self.inflight > 0:
+                self.inflight -= 1
+
+    def publish(self, lsid, condition):
+        # Runs on the concurrent thread, once per condition in each poll or broadcast
+
+        published = self.published.get(lsid)
+        if published is None:
+            published = self.published[lsid] = {}
+        changed = [key for key, value in condition.iteritems() if published.get(key, published) != value]
+
+        if self.format == "json":
+            if not changed and lsid not in self.unsent:
+                return
+            for key in changed:
+                published[key] = condition[key]
+            if self.send(u"{}/{}".format(self.prefix, lsid), json.dumps(published, separators=(',', ':'))):
+                self.unsent.discard(lsid)
+            else:
+                self.unsent.add(lsid)
+            return
+
+        for key in changed:
+            value = condition[key]
+            if self.send(u"{}/{}/{}".format(self.prefix, lsid, key), json.dumps(value)):
+                published[key] = value
+            else:
+                published.pop(key, None)
+
+    def send(self, topic, payload):
+        with self.lock:
+            if self.inflight >= kQueueLimit:
+                self.perfStats.count('mqtt_dropped', self.name)
+                return False
+            self.inflight += 1
+
+        result = self.client.publish(topic, payload, qos=self.qos, retain=True)
+        # While disconnected paho holds QoS 1/2 messages for the next connection but still returns MQTT_ERR_NO_CONN
+        if result.rc == paho.MQTT_ERR_SUCCESS or (result.rc == paho.MQTT_ERR_NO_CONN and self.qos > 0):
+            self.perfStats.count('mqtt_published', self.name)
+            return True
+
+        with self.lock:
+            if self.inflight > 0:
+                self.inflight -= 1
+        self.perfStats.count('mqtt_dropped', self.name)
+        self.logger.threaddebug(u"MQTT publish to %s not queued: %s", topic, paho.error_string(result.rc))
+        return False
@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import time
+import json
+import sqlite3
+import logging
+
+################################################################################
+#
+#   Observations that couldn't be uploaded because the weather network was
+#   unreachable, kept in a SQLite database so they survive plugin restarts and
+#   sent later in small batches.  Each sender's queue is bounded by count and
+#   by age, oldest observations are dropped first.  Only used from the
+#   concurrent thread.
+#
+################################################################################
+
+kSchema = [
+    "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, sender INTEGER NOT NULL, ts REAL NOT NULL, data TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS outbox_sender ON outbox (sender, id)"
+]
+
+kQueueLimit = 1000          # observations kept per sender
+
+
+class UploadQueue(object):
+
+    def __init__(self, path):
+        self.logger = logging.getLogger("Plugin.UploadQueue")
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        for statement in kSchema:
+            self.db.execute(statement)
+        self.db.commit()
+
+        self.counts = dict(self.db.execute("SELECT sender, COUNT(*) FROM outbox GROUP BY sender"))
+        if self.counts:
+            self.logger.debug(u"UploadQueue opened {}, queued observations: {}".format(path, self.counts))
+
+    def close(self):
+        self.db.close()
+
+    def count(self, sender):
+        return self.counts.get(sender, 0)
+
+    def push(self, sender, data):
+        self.db.execute("INSERT INTO outbox (sender, ts, data) VALUES (?, ?, ?)", (sender, time.time(), json.dumps(data)))
+        count = self.counts.get(sender, 0) + 1
+        if count > kQueueLimit:
+            self.db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE sender = ? ORDER BY id LIMIT ?)",
+                            (sender, count - kQueueLimit))
+            count = kQueueLimit
+        self.db.commit()
+        self.counts[sender] = count
+
+    def peek(self, sender, limit, maxAge):
+        # Returns up to limit [(id, data)] for the sender, oldest first, after dropping observations older than maxAge seconds
+
+        cursor = self.db.execute("DELETE FROM outbox WHERE sender = ? AND ts < ?", (sender, time.time() - maxAge))
+        if cursor.rowcount:
+            self.db.commit()
+            self.counts[sender] = max(self.counts.get(sender, 0) - cursor.rowcount, 0)
+            self.logger.debug(u"UploadQueue dropped {} expired observations for sender {}".format(cursor.rowcount, sender))
+
+        rows = self.db.execute("SELECT id, data FROM outbox WHERE sender = ? ORDER BY id LIMIT ?", (sender, limit))
+        return [(rowId, json.loads(data)) for rowId, data in rows]
+
+    def remove(self, sender, ids):
+        if not ids:
+            return
+        self.db.executemany("DELETE FROM outbox WHERE id = ?", [(rowId,) for rowId in ids])
+        self.db.commit()
+        self.counts[sender] = max(self.counts.get(sender, 0) - len(ids), 0)
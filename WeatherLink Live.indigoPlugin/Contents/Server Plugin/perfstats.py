@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import time
+import threading
+from bisect import bisect_left
+
+################################################################################
+#
+#   Always-on counters and latency histograms for the plugin's hot paths,
+#   indexed by (stage, source) where source is a base station, sender or port.
+#   Recording is a few arithmetic operations, nothing is done while idle.
+#
+################################################################################
+
+# histogram bucket upper bounds, in seconds
+kBuckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.histogram = [0] * (len(kBuckets) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.histogram[bisect_left(kBuckets, seconds)] += 1
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the requested fraction of samples
+        target = self.count * fraction
+        seen = 0
+        for i, hits in enumerate(self.histogram):
+            seen += hits
+            if seen >= target and hits:
+                return kBuckets[i] if i < len(kBuckets) else self.max
+        return 0.0
+
+    def summary(self):
+        return u"count {}, avg {:.2f} ms, p50 <= {:.2f} ms, p95 <= {:.2f} ms, max {:.2f} ms".format(
+            self.count, self.total / self.count * 1000.0 if self.count else 0.0,
+            self.percentile(0.5) * 1000.0, self.percentile(0.95) * 1000.0, self.max * 1000.0)
+
+
+class PerfStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()    # worker threads record too
+        self.started = time.time()
+        self.timers = {}                # StageTimer, indexed by (stage, source)
+        self.counters = {}              # int, indexed by (counter, source)
+
+    def record(self, stage, source, seconds):
+        with self.lock:
+            timer = self.timers.get((stage, source))
+            if timer is None:
+                timer = self.timers[(stage, source)] = StageTimer()
+            timer.record(seconds)
+
+    def count(self, counter, source, increment=1):
+        with self.lock:
+            self.counters[(counter, source)] = self.counters.get((counter, source), 0) + increment
+
+    def timed(self, stage, source, function):
+        # Wrap function so each call's duration is recorded, for jobs handed to a WorkerPool
+        def run(*args):
+            began = time.time()
+            try:
+                return function(*args)
+            finally:
+                self.record(stage, source, time.time() - began)
+        return run
+
+    def timer(self, stage, source):
+        return self.timers.get((stage, source))
+
+    def counter(self, counter, source):
+        return self.counters.get((counter, source), 0)
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.timers = {}
+            self.counters = {}
+
+    def report(self):
+        with self.lock:
+            lines = [u"Performance statistics for the last {:.0f} seconds:".format(time.time() - self.started)]
+            for (stage, source), timer in sorted(self.timers.items()):
+                lines.append(u"    {:<16} {:<24} {}".format(stage, source, timer.summary()))
+            for (counter, source), value in sorted(self.counters.items()):
+                lines.append(u"    {:<16} {:<24} {}".format(counter, source, value))
+        return u"\n".join(lines)
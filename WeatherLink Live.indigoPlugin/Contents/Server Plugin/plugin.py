@@ -7,14 +7,46 @@ try:
 except ImportError:
     pass
 
+import os
 import time
+import fcntl
+import errno
+import select
 import logging
+import threading
+from collections import deque
 from aprs import APRS
 from pws import PWS
 from wunderground import WU
 from weatherlink import WeatherLink
+import decoder
+from listener import UDPListener
+from shard import StationShard
+from statecache import StateCache
+from workers import WorkerPool
+from history import HistoryStore
+from aggregates import AggregateEngine
+from perfstats import PerfStats
+from profiler import LoopProfiler
+from scheduler import Scheduler
+from snapshot import ConditionSnapshot
+from outbox import UploadQueue
+from localapi import LocalAPI
+import mqttsink
+from replay import ReplayBenchmark, loadRecording, saveRecording
+from records import StateRecord
+from conversions import buildConversionTable, kRainCollector, kRenamedStates
 
 kCurDevVersCount = 0        # current version of plugin devices
+
+kHistoryFlush = 10.0        # seconds history readings are batched before being written
+kNoDataRetry = 30.0         # seconds before retrying an upload when no readings have been received yet
+kBackfillBatch = 10         # queued observations sent per backfill job
+kBackfillInterval = 10.0    # seconds between backfill batches, so live uploads get their turn
+kRetryStatuses = ("Request Error", "Send Error", "Server Error")    # upload failures worth queueing for later
+kHTTPWorkers = 4            # threads available for WeatherLink HTTP requests
+kUploadWorkers = 2          # threads available for weather network uploads
+kRecordedPackets = 200      # recent condition packets kept for the replay benchmark
         
         
 ################################################################################
@@ -34,16 +66,64 @@ class Plugin(indigo.PluginBase):
 
     def startup(self):
         self.logger.info(u"Starting WeatherLink Live")
+        self.logger.debug(u"Decoding JSON with {}".format(decoder.kBackend))
 
         self.updateNeeded = False
         self.weatherlinks = {}          # Dict of Indigo WeatherLink devices, indexed by device.id
         self.sensorDevices = {}         # Dict of Indigo sensor/transmitter devices, indexed by device.id
+        self.sensorsByLsid = {}         # Dict of lists of Indigo sensor/transmitter devices, indexed by address (lsid)
         self.senders = {}               # Dict of Indigo APRS account devices, indexed by device.id
+        self.rapidSenders = {}          # Dict of senders with RapidFire updates enabled, indexed by device.id
         self.knownDevices = {}          # Dict of sensor/transmitter devices received by base station, indexed by lsid
-        
+        self.listeners = {}             # Dict of shared UDP broadcast listeners, indexed by port
+        self.shards = {}                # Dict of StationShard worker processes, indexed by WeatherLink device.id
+        self.shardStations = self.pluginPrefs.get("shardStations", False)
+        self.udpRoutes = {}             # Dict of WeatherLink device.id, indexed by (did, sender address) of broadcasts
+        self.stateCache = StateCache()  # Last state values pushed to the server, so unchanged states aren't re-sent
+        self.aggregates = AggregateEngine() # Rolling statistics of the condition stream, published as derived states
+        self.snapshot = ConditionSnapshot() # Latest raw ISS and barometer readings, for the senders
+        self.recorded = deque(maxlen=kRecordedPackets)  # Recent condition packets, for the replay benchmark
+        self.perfStats = PerfStats()    # Hot path timings and counters, indexed by stage and source
+        self.perfStates = self.pluginPrefs.get("perfStates", False)
+        self.profiler = None            # LoopProfiler session requested from the menu, None when not profiling
+        self.benchmark = None           # thread running a replay benchmark requested from the menu
+        self.scheduler = Scheduler()    # Timed jobs of the concurrent thread, indexed by (job, device.id)
+
+        self.compileConversions(self.pluginPrefs)
+
+        self.history = None
+        self.configureHistory(self.pluginPrefs)
+
+        self.localAPI = None
+        self.configureLocalAPI(self.pluginPrefs)
+
+        self.mqtt = None
+        self.configureMQTT(self.pluginPrefs)
+
+        self.outbox = UploadQueue(u"{}/Preferences/Plugins/{}/outbox.db".format(indigo.server.getInstallFolderPath(), self.pluginId))
+
+        # pipe used to wake the concurrent thread out of select() when something changes
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        fcntl.fcntl(self.wakeup_write, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        self.httpPool = WorkerPool("http", kHTTPWorkers, self.wakeLoop)
+        self.uploadPool = WorkerPool("upload", kUploadWorkers, self.wakeLoop)
                     
     def shutdown(self):
         self.logger.info(u"Shutting down WeatherLink Live")
+        self.httpPool.stop()
+        self.uploadPool.stop()
+        for listener in self.listeners.values():
+            listener.stop()
+        for shard in self.shards.values():
+            shard.stop()
+        if self.history:
+            self.history.close()
+        self.outbox.close()
+        if self.localAPI:
+            self.localAPI.stop()
+        if self.mqtt:
+            self.mqtt.stop()
 
 
     def runConcurrentThread(self):
@@ -51,31 +131,383 @@ class Plugin(indigo.PluginBase):
         try:
             while True:
 
-                # Process any broadcast data from weather stations
-                
-                for link in self.weatherlinks.values():
-                    self.processConditions(link.udp_receive())
+                if self.profiler and not self.profiler.profile:
+                    self.checkProfiler()
+
+                # Wait for broadcast data from weather stations, or until the next timed job is due
 
-                # Get non-broadcast data from weather stations per schedule or forced update
+                timeout = self.scheduler.timeout()
+                expected = time.time()
+                self.receiveBroadcasts(timeout)
+                if timeout is not None:
+                    lag = time.time() - (expected + timeout)
+                    if lag > 0.0:
+                        self.perfStats.record('loop_lag', u'concurrent thread', lag)
 
-                for link in self.weatherlinks.values():
-                    if (time.time() > link.next_poll) or self.updateNeeded:
-                        self.processConditions(link.http_poll())
-                        self.sleep(2.0)
-                        link.udp_start()
-                self.updateNeeded = False
+                # Handle any completed HTTP requests and uploads, which schedule their device's next job
 
-                # Upload weather data to networks as needed
+                self.httpPool.processResults()
+                self.uploadPool.processResults()
+
+                # Forced update of every base station, after device changes
+
+                if self.updateNeeded:
+                    self.updateNeeded = False
+                    for link in self.weatherlinks.values():
+                        self.scheduler.schedule(('poll', link.device.id), time.time())
+
+                # Run the timed jobs that are due
+
+                for job, deviceId in self.scheduler.popDue():
+                    self.runJob(job, deviceId)
+
+        except self.StopThread:
+            if self.profiler and self.profiler.profile:
+                self.profiler.stop()
+            self.profiler = None
+
+    def stopConcurrentThread(self):
+        indigo.PluginBase.stopConcurrentThread(self)
+        self.wakeLoop()
+
+    def wakeLoop(self):
+        try:
+            os.write(self.wakeup_write, b'x')
+        except OSError:
+            pass
+
+    def runJob(self, job, deviceId):
+    
+        if job == 'history':
+            if self.history:
+                began = time.time()
+                self.history.flush()
+                self.perfStats.record('history', u"flush", time.time() - began)
+            return
+        elif job == 'profiler':
+            if self.profiler:
+                self.checkProfiler()
+            return
+        elif job == 'upload':
+            sender = self.senders.get(deviceId)
+            if sender and not sender.upload_pending:
+                self.startUpload(sender)
+            return
+        elif job == 'backfill':
+            sender = self.senders.get(deviceId)
+            if sender and not sender.upload_pending:
+                self.startBackfill(sender)
+            elif sender:
+                self.scheduler.schedule(('backfill', deviceId), time.time() + kBackfillInterval)
+            return
+
+        # WeatherLink jobs, one HTTP request at a time per link.  Completion reschedules, so jobs
+        # that come due while a request is pending aren't lost.
+            
+        link = self.weatherlinks.get(deviceId)
+        if not link or link.http_pending:
+            return
+        if job == 'poll':
+            self.startPoll(link)
+        elif job == 'real_time':
+            self.startRealTime(link)
+        elif job == 'gap':
+            # Renew the broadcast lease early if broadcasts have stopped
+            link.udp_gap_check(time.time())
+            self.scheduleLink(link)
+
+    def scheduleLink(self, link):
+        # Register the link's timers, after anything that may have changed them
+        
+        if link.http_pending:
+            return
+        self.scheduler.schedule(('poll', link.device.id), link.next_poll)
+        if link.next_udp_start:
+            self.scheduler.schedule(('real_time', link.device.id), link.next_udp_start)
+        else:
+            self.scheduler.cancel(('real_time', link.device.id))
+        gap = link.udp_gap_due()
+        if gap:
+            self.scheduler.schedule(('gap', link.device.id), gap)
+        else:
+            self.scheduler.cancel(('gap', link.device.id))
+
+    def scheduleSender(self, sender):
+        if not sender.upload_pending:
+            self.scheduler.schedule(('upload', sender.device.id), sender.next_update)
+
+    def receiveBroadcasts(self, timeout):
+    
+        socketMap = {}
+        for listener in self.listeners.values():
+            if listener.sock:
+                socketMap[listener.sock] = listener
+        shardMap = {}
+        for shard in self.shards.values():
+            if shard.conn:
+                shardMap[shard.conn] = shard
+
+        try:
+            readable, writable, exceptional = select.select(socketMap.keys() + shardMap.keys() + [self.wakeup_read], [], [], timeout)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                self.logger.error(u"receiveBroadcasts select error: {}".format(err))
+            readable = []
+
+        if self.stopThread:
+            raise self.StopThread
+
+        for sock in readable:
+            if sock == self.wakeup_read:
+                os.read(self.wakeup_read, 512)
+                continue
+            if sock in shardMap:
+                self.shardMessages(shardMap[sock])
+                continue
                 
-                for aprs in self.senders.values():
-                    if time.time() > aprs.next_update:                    
-                        aprs.send_update()
+            # drain every datagram queued on this socket, not just the first one
+            listener = socketMap[sock]
+            while True:
+                began = time.time()
+                packet = listener.receive()
+                if packet is None:
+                    break
+                self.perfStats.record('udp_receive', listener.name, time.time() - began)
+                self.routeBroadcast(*packet)
+
+    def checkProfiler(self):
+        # Runs on the concurrent thread, which is the one cProfile needs to be enabled on
+        if not self.profiler.profile:
+            self.profiler.start()
+            self.scheduler.schedule(('profiler', None), self.profiler.stop_at)
+        elif time.time() >= self.profiler.stop_at:
+            try:
+                self.profiler.stop()
+            except Exception as err:
+                self.logger.error(u"Error writing profile: {}".format(err))
+            self.profiler = None
+
+    def startPoll(self, link):
+        link.start_poll()
+        if link.device.id in self.shards:
+            if not self.shards[link.device.id].poll():
+                self.pollComplete(link, None)
+            return
+        self.httpPool.submit(self.perfStats.timed('http_poll', link.device.name, link.http_poll), 
+                             lambda result: self.pollComplete(link, result))
+
+    def pollComplete(self, link, result):
+        if self.weatherlinks.get(link.device.id) is not link:
+            return      # the device was stopped or restarted while the request was in flight
+        if result and result[0] == 'JSON Error':
+            self.perfStats.count('decode_errors', link.device.name)
+        self.stateCache.begin()
+        try:
+            conditions = link.http_poll_complete(result)
+            if self.localAPI and conditions:
+                self.localAPI.publish(link.did, link.ts, conditions, 'http')
+            self.processConditions(conditions, link.device.name)
+            if self.perfStates:
+                link.update_perf_states(self.perfStats)
+        finally:
+            self.commitStates(link.device.name)
+        self.scheduleLink(link)
+
+    def commitStates(self, source):
+        # Send the state and image changes collected while processing one poll or broadcast
+        began = time.time()
+        self.stateCache.commit()
+        self.perfStats.record('commit', source, time.time() - began)
+
+    def startRealTime(self, link):
+        link.next_udp_start = None
+        link.http_pending = True
+        if link.device.id in self.shards:
+            if not self.shards[link.device.id].realTime():
+                self.realTimeComplete(link, None)
+            return
+        self.httpPool.submit(self.perfStats.timed('real_time', link.device.name, link.udp_start), lambda result: self.realTimeComplete(link, result))
+
+    def realTimeComplete(self, link, result):
+        if self.weatherlinks.get(link.device.id) is not link:
+            return      # the device was stopped or restarted while the request was in flight
+        port = link.udp_start_complete(result)
+        shard = self.shards.get(link.device.id)
+        if shard:
+            shard.listen(port)
+        elif not self.shardStations:
+            self.startListener(port)    # a sharded station never gets the plugin-wide listener, even if its shard is gone
+        self.scheduleLink(link)
+
+    def shardMessages(self, shard):
+        # Completed requests and decoded broadcasts from a station's shard process, handled as if they were local
+        for kind, result in shard.receive():
+            if kind == 'poll':
+                self.pollComplete(shard.link, result)
+            elif kind == 'real_time':
+                self.realTimeComplete(shard.link, result)
+            else:
+                self.processBroadcast(shard.link, result)
 
+    def senderReadings(self, sender):
+        issDev = self.sensorDevices.get(sender.iss_device)
+        baroDev = self.sensorDevices.get(sender.baro_device)
+        return self.snapshot.readings(issDev.address, baroDev.address) if issDev and baroDev else None
+
+    def startUpload(self, sender):
+        readings = self.senderReadings(sender)
+        if readings is None:
+            self.logger.debug(u"%s: No ISS and barometer readings yet, upload postponed", sender.device.name)
+            sender.next_update = time.time() + kNoDataRetry
+            self.scheduleSender(sender)
+            return
             
-                self.sleep(1.0)
+        try:
+            data = sender.start_update(readings)
+        except Exception as err:
+            self.logger.error(u"{}: Unable to assemble upload data: {}".format(sender.device.name, err))
+            sender.send_complete("Data Error")
+            self.scheduleSender(sender)
+            return
+        self.uploadPool.submit(self.perfStats.timed('upload', sender.device.name, sender.send_update), 
+                               lambda status: self.uploadComplete(sender, status, data), data)
 
-        except self.StopThread:
-            pass        
+    def uploadComplete(self, sender, status, data):
+        if status in kRetryStatuses:
+            # queued even if the sender was stopped meanwhile, a restarted one backfills it
+            self.outbox.push(sender.device.id, data)
+            self.logger.debug(u"%s: Upload queued, %d waiting", sender.device.name, self.outbox.count(sender.device.id))
+        if self.senders.get(sender.device.id) is not sender:
+            return      # the device was stopped or restarted while the upload was in flight
+        if status != "OK":
+            self.perfStats.count('upload_errors', sender.device.name)
+        if status == "OK" and self.outbox.count(sender.device.id):
+            self.scheduler.schedule(('backfill', sender.device.id), time.time())
+        sender.send_complete(status)
+        self.scheduleSender(sender)
+        if self.perfStates:
+            timer = self.perfStats.timer('upload', sender.device.name)
+            stateList = [
+                { 'key':'perf_upload_ms',     'value': round(timer.last * 1000.0, 1) if timer else 0.0},
+                { 'key':'perf_upload_errors', 'value': self.perfStats.counter('upload_errors', sender.device.name)}
+            ]
+            self.stateCache.updateStates(sender.device, stateList)
+
+    def startBackfill(self, sender):
+        # Sends the oldest queued observations, one batch per job so the sender's live uploads aren't held up
+        
+        batch = self.outbox.peek(sender.device.id, kBackfillBatch, sender.backfill_age)
+        if not batch:
+            return
+        sender.upload_pending = True
+        self.uploadPool.submit(self.sendBackfill, lambda result: self.backfillComplete(sender, result), sender, batch)
+
+    def sendBackfill(self, sender, batch):
+        # Runs on an upload worker thread, returns the ids of the observations (sent, rejected),
+        # stopping at the first failure that's worth retrying
+        
+        sent = []
+        rejected = []
+        for rowId, data in batch:
+            status = sender.send_update(data)
+            if status == "OK":
+                sent.append(rowId)
+            elif status in kRetryStatuses:
+                break
+            else:
+                rejected.append(rowId)
+        return sent, rejected
+
+    def backfillComplete(self, sender, result):
+        sender.upload_pending = False
+        sent, rejected = result or ([], [])
+        self.outbox.remove(sender.device.id, sent + rejected)
+        if self.senders.get(sender.device.id) is not sender:
+            return      # the device was stopped or restarted while the backfill was in flight
+        remaining = self.outbox.count(sender.device.id)
+        if rejected:
+            self.logger.warning(u"{}: Discarded {} queued observations rejected by the server".format(sender.device.name, len(rejected)))
+        if sent or rejected:
+            self.logger.info(u"{}: Sent {} queued observations, {} remaining".format(sender.device.name, len(sent), remaining))
+            if remaining:
+                self.scheduler.schedule(('backfill', sender.device.id), time.time() + kBackfillInterval)
+        self.scheduleSender(sender)
+
+    def offerRapidFire(self):
+        # Called after each packet.  Senders with a request still in flight, or backing off, skip this packet.
+        now = time.time()
+        for sender in self.rapidSenders.values():
+            if sender.rapid_pending or now < sender.next_rapid:
+                continue
+            readings = self.senderReadings(sender)
+            if readings is None:
+                continue
+            try:
+                data = sender.start_rapid(readings)
+            except Exception as err:
+                self.logger.debug(u"%s: Unable to assemble RapidFire data: %s", sender.device.name, err)
+                sender.rapid_complete("Data Error")
+                continue
+            self.uploadPool.submit(self.perfStats.timed('rapid_fire', sender.device.name, sender.send_rapid),
+                                   lambda status, sender=sender: self.rapidComplete(sender, status), data)
+
+    def rapidComplete(self, sender, status):
+        if self.rapidSenders.get(sender.device.id) is not sender:
+            return      # the device was stopped or restarted while the update was in flight
+        if status != "OK":
+            self.perfStats.count('rapid_fire_errors', sender.device.name)
+        sender.rapid_complete(status)
+
+    def startListener(self, port):
+        if not port:
+            return
+        if port not in self.listeners:
+            self.listeners[port] = UDPListener(port, self.perfStats)
+        self.listeners[port].start()
+
+    def routeBroadcast(self, address, json_data):
+
+        did = json_data.get('did') if json_data else None
+        link = self.weatherlinks.get(self.udpRoutes.get((did, address)))
+        if not link:
+            link = self.findBroadcastLink(did, address)
+            if not link:
+                self.logger.threaddebug(u"routeBroadcast: no WeatherLink for did = %s, address = %s", did, address)
+                self.perfStats.count('packets_dropped', address)
+                return
+            if did and link.did == did:
+                self.udpRoutes[(did, address)] = link.device.id
+
+        self.processBroadcast(link, json_data)
+
+    def findBroadcastLink(self, did, address):
+        # Stations can share an address (port forwarding, NAT), so the did decides.  The sender address is
+        # only used for links whose did isn't known yet, and for packets that couldn't be decoded.
+
+        if did:
+            for link in self.weatherlinks.values():
+                if link.did == did:
+                    return link
+        for link in self.weatherlinks.values():
+            if link.ip_address == address and (not did or link.did is None):
+                return link
+        return None
+
+    def processBroadcast(self, link, json_data):
+        if json_data is None:
+            self.perfStats.count('decode_errors', link.device.name)
+            link.udp_error('JSON Error')
+            return
+            
+        self.perfStats.count('packets', link.device.name)
+        self.stateCache.begin()
+        try:
+            conditions = link.udp_process(json_data)
+            if self.localAPI:
+                self.localAPI.publish(link.did, link.ts, conditions, 'udp')
+            self.processConditions(conditions, link.device.name)
+        finally:
+            self.commitStates(link.device.name)
 
 ################################################################################
 #
@@ -83,11 +515,12 @@ class Plugin(indigo.PluginBase):
 #
 ################################################################################
  
-    def processConditions(self, conditions):
+    def processConditions(self, conditions, source=u""):
     
         if conditions == None:
             return
         
+        now = time.time()
         for condition in conditions:
 
             sensor_lsid = str(condition['lsid'])
@@ -96,122 +529,153 @@ class Plugin(indigo.PluginBase):
             if sensor_lsid not in self.knownDevices:
                 sensorInfo = {"lsid": sensor_lsid, "type": sensor_type}
                 self.knownDevices[sensor_lsid] = sensorInfo
-                self.logger.debug(u"Added sensor {} to knownDevices: {}".format(sensor_lsid, sensorInfo))
+                self.logger.debug(u"Added sensor %s to knownDevices: %s", sensor_lsid, sensorInfo)
                 
+            if self.mqtt:
+                self.mqtt.publish(sensor_lsid, condition)
+
+            sensorDevs = self.sensorsByLsid.get(sensor_lsid)
+            if not sensorDevs:
+                continue
+                
+            if sensor_type in ('1', '3'):
+                self.snapshot.update(sensor_lsid, condition)
+
+            record = self.conditionRecord(sensor_lsid, condition, now, self.aggregates)
+            converted = time.time()
+            self.perfStats.record('convert', source, converted - now)
+            
+            for sensorDev in sensorDevs:
+                changed = self.stateCache.updateRecord(sensorDev, record)
+                self.logger.threaddebug(u"%s: Updating sensor: %s", sensorDev.name, changed)
+            now = time.time()
+            self.perfStats.record('push', source, now - converted)
+
+            if self.history:
+                self.history.record(sensor_lsid, record, now)
 
-            for sensorDev in self.sensorDevices.values():
-                if sensorDev.address == sensor_lsid:
-                    stateList = self.sensorDictToList(condition)
-                    sensorDev.updateStatesOnServer(stateList)
-                    self.logger.threaddebug(u"{}: Updating sensor: {}".format(sensorDev.name, stateList))
+        if self.history and not self.scheduler.scheduled(('history', None)):
+            self.scheduler.schedule(('history', None), time.time() + kHistoryFlush)
+
+        self.recorded.append(conditions)
+
+        if self.rapidSenders:
+            self.offerRapidFire()
+
+    def conditionRecord(self, sensor_lsid, condition, now, aggregates):
+        # Converted states for one condition, plus the derived states it updates
+        
+        record = self.sensorDictToRecord(condition)
+        for key, sourceKey, value in aggregates.update(sensor_lsid, condition, now):
+            value, uiValue, decimalPlaces = self.conversions[sourceKey](value, None)
+            record.add(key, value, uiValue, decimalPlaces)
+        return record
 
 
 ################################################################################
 #
-#   convert the raw dict the WLL provides to a device-state list, including conversion and UI state generation
+#   convert the raw dict the WLL provides to a StateRecord, including conversion and UI state generation
 #
 ################################################################################
               
-    def sensorDictToList(self, sensor_dict):
-        # Retrieve user selected reporting units
-        units_temperature = self.pluginPrefs.get("units_temperature", "F")
-        units_barometric_pressure = self.pluginPrefs.get("units_barometric_pressure", "IN")
-        units_wind = self.pluginPrefs.get("units_wind", "MPH")
-
-        def temperature_conversion(value_to_convert):
-            if units_temperature == "C":
-                return (((value_to_convert - 32.0) * 5.0) / 9.0), "C"
-            else:
-                # Assume default Fahrenheit
-                return value_to_convert, "F"
-
-        def barometric_pressure_conversion(value_to_convert):
-            if units_barometric_pressure == "MM":
-                return value_to_convert * 25.4, "mm"
-            elif units_barometric_pressure == "MB":
-                return value_to_convert * 33.8639, "mb"
-            elif units_barometric_pressure == "HP":
-                return value_to_convert * 33.8639, "hPa"
-            else:
-                # Assume default Inches
-                return value_to_convert, "in"
-
-        def wind_conversion(value_to_convert):
-            if units_wind == "KNO":
-                return value_to_convert * 0.868976, "knots"
-            elif units_wind == "KPH":
-                return value_to_convert * 1.60934, "km/h"
-            elif units_wind == "MPS":
-                return value_to_convert * 0.44704, "m/s"
-            else:
-                # Assume default MPH
-                return value_to_convert, "mph"
-
-        # get values to convert rain counts to actual units
-        rainCollector = {   0: (None, None),
-                            1: (0.01,  "in"),
-                            2: (0.2,   "mm"),
-                            3: (0.1,   "mm"),
-                            4: (0.001, "in")
-        }
-        factor, units = rainCollector[sensor_dict.get('rain_size', 1)]
+    def sensorDictToRecord(self, sensor_dict):
+
+        rain = kRainCollector[sensor_dict.get('rain_size', 1)]
+        conversions = self.conversions
         
-        sensorList = []
+        record = StateRecord()
+        addKey, addValue, addUiValue, addDecimals = record.keys.append, record.values.append, record.uiValues.append, record.decimalPlaces.append
         for key, value in sensor_dict.items():
                     
-            # consolidate redundant states (same info from http and udp with different names)
-            if key == "rainfall_last_15_min":
-                key = "rain_15_min"
-            elif key == "rainfall_last_60_min":
-                key = "rain_60_min"
-            elif key == "rainfall_last_24_hr":
-                key = "rain_24_hr"
+            key = kRenamedStates.get(key, key)
 
             if not (isinstance(value, int) or isinstance(value, float)):
-                self.logger.threaddebug("sensorDictToList: key = {}, value = {} ({}) coerced to value 0".format(key, value, type(value)))
+                self.logger.threaddebug("sensorDictToRecord: key = %s, value = %s (%s) coerced to value 0", key, value, type(value))
                 value = 0
             
-            if key in ['temp','temp_in', 'dew_point', 'dew_point_in', 'heat_index_in', 'wind_chill', 'wet_bulb', 'heat_index', 'thw_index', 'thsw_index']:
-                value, ui_label = temperature_conversion(value)
-                sensorList.append({'key': key, 'value': value, 'decimalPlaces': 1, 'uiValue': u'{:.1f} °{}'.format(value, ui_label)})
-                
-            elif key in ['temp_1','temp_2', 'temp_3', 'temp_4']:
-                value, ui_label = temperature_conversion(value)
-                sensorList.append({'key': key, 'value': value, 'decimalPlaces': 1, 'uiValue': u'{:.1f} °{}'.format(value, ui_label)})
-                
-            elif key in ['hum', 'hum_in']:
-                sensorList.append({'key': key, 'value': value, 'decimalPlaces': 0, 'uiValue': u'{:.0f}%'.format(value)})
-            
-            elif key in ['bar_sea_level', 'bar_trend', 'bar_absolute']:
-                value, ui_label = barometric_pressure_conversion(value)
-                sensorList.append({'key': key, 'value': value, 'decimalPlaces': 2, 'uiValue': u'{:.2f} {}'.format(value, ui_label)})
-            
-            elif key in ['wind_speed_last', 'wind_speed_avg_last_1_min', 'wind_speed_avg_last_2_min', 'wind_speed_hi_last_2_min', 
-                         'wind_speed_avg_last_10_min', 'wind_speed_hi_last_10_min']:
-                value, ui_label = wind_conversion(value)
-                sensorList.append({'key': key, 'value': value, 'decimalPlaces': 0, 'uiValue': u'{:.0f} {}'.format(value, ui_label)})
-            
-            elif key in ['wind_dir_last', 'wind_dir_scalar_avg_last_1_min', 'wind_dir_scalar_avg_last_2_min', 'wind_dir_at_hi_speed_last_2_min', 
-                         'wind_dir_scalar_avg_last_10_min', 'wind_dir_at_hi_speed_last_10_min']:
-                sensorList.append({'key': key, 'value': value, 'decimalPlaces': 0, 'uiValue': u'{:d}°'.format(value)})
-            
-            elif key in ['rain_storm_start_at', 'rain_storm_last_end_at', 'rain_storm_last_start_at', 'timestamp']:
-                time_string = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime(float(value)))
-                sensorList.append({'key': key, 'value': time_string, 'decimalPlaces': 0, 'uiValue': u'{}'.format(time_string)})
-
-            elif key in ['rain_rate_last', 'rain_rate_hi', 'rain_rate_hi_last_15_min', 'rain_storm_last']:
-                rain = float(value) * factor
-                sensorList.append({'key': key, 'value': rain, 'decimalPlaces': 2, 'uiValue': u'{:.2f} {}/hr'.format(rain, units)})
-            
-            elif key in ['rain_15_min', 'rain_60_min', 'rain_24_hr', 'rain_storm', 'rain_storm_last',
-                        'rainfall_daily', 'rainfall_monthly', 'rainfall_year']:
-                rain = float(value) * factor
-                sensorList.append({'key': key, 'value': rain, 'decimalPlaces': 2, 'uiValue': u'{:.2f} {}'.format(rain, units)})
-            
+            conversion = conversions.get(key)
+            addKey(key)
+            if conversion:
+                value, uiValue, decimalPlaces = conversion(value, rain)
+                addValue(value)
+                addUiValue(uiValue)
+                addDecimals(decimalPlaces)
             else:        
-                sensorList.append({'key': key, 'value': value})
+                addValue(value)
+                addUiValue(None)
+                addDecimals(None)
         
-        return sensorList
+        return record
+
+    def compileConversions(self, prefs):
+        # Rebuild the state conversion table for the user selected reporting units
+        self.conversions = buildConversionTable(prefs.get("units_temperature", "F"), 
+                                                prefs.get("units_barometric_pressure", "IN"), 
+                                                prefs.get("units_wind", "MPH"))
+
+
+    def configureHistory(self, prefs):
+        # Open or close the sensor history database to match the plugin prefs
+        
+        if self.history:
+            self.history.close()
+            self.history = None
+            
+        if not prefs.get("enableHistory", False):
+            return
+
+        path = u"{}/Preferences/Plugins/{}/history.db".format(indigo.server.getInstallFolderPath(), self.pluginId)
+        try:
+            self.history = HistoryStore(path, int(prefs.get("historyDays", "365")))
+        except Exception as err:
+            self.logger.error(u"Unable to open sensor history {}: {}".format(path, err))
+
+
+    def configureLocalAPI(self, prefs):
+        # Start, restart or stop the local conditions server to match the plugin prefs
+
+        enabled = prefs.get("enableLocalAPI", False)
+        port = int(prefs.get("localAPIPort", "8765")) if enabled else None
+        if self.localAPI:
+            if self.localAPI.port == port:
+                return
+            self.localAPI.stop()
+            self.localAPI = None
+
+        if not enabled:
+            return
+
+        try:
+            self.localAPI = LocalAPI(port)
+        except Exception as err:
+            self.logger.error(u"Unable to start local API on port {}: {}".format(port, err))
+
+
+    def configureMQTT(self, prefs):
+        # Connect, reconnect or disconnect the MQTT sink to match the plugin prefs
+
+        settings = None
+        if prefs.get("enableMQTT", False):
+            settings = (prefs.get("mqttHost", ""), int(prefs.get("mqttPort", "1883")), prefs.get("mqttTopic", "weatherlink"),
+                        int(prefs.get("mqttQoS", "0")), prefs.get("mqttFormat", "keys"),
+                        prefs.get("mqttUsername", ""), prefs.get("mqttPassword", ""))
+        if self.mqtt:
+            if self.mqttSettings == settings:
+                return
+            self.mqtt.stop()
+            self.mqtt = None
+
+        self.mqttSettings = settings
+        if not settings:
+            return
+        if not mqttsink.paho:
+            self.logger.error(u"MQTT publishing requires the paho-mqtt package, which isn't installed")
+            return
+
+        try:
+            self.mqtt = mqttsink.MQTTSink(*(settings + (self.perfStats,)))
+        except Exception as err:
+            self.logger.error(u"Unable to start MQTT publishing to {}: {}".format(settings[0], err))
 
 
     ########################################
@@ -227,6 +691,27 @@ class Plugin(indigo.PluginBase):
             self.logLevel = logging.INFO
         self.indigo_log_handler.setLevel(self.logLevel)
 
+        try:
+            if int(valuesDict.get(u"historyDays", "365")) < 1:
+                raise ValueError
+        except ValueError:
+            errorDict[u"historyDays"] = u"History retention must be a whole number of days"
+
+        try:
+            if not 0 < int(valuesDict.get(u"localAPIPort", "8765")) < 65536:
+                raise ValueError
+        except ValueError:
+            errorDict[u"localAPIPort"] = u"Port must be a number between 1 and 65535"
+
+        if valuesDict.get(u"enableMQTT", False):
+            if not valuesDict.get(u"mqttHost", ""):
+                errorDict[u"mqttHost"] = u"Broker address is required"
+            try:
+                if not 0 < int(valuesDict.get(u"mqttPort", "1883")) < 65536:
+                    raise ValueError
+            except ValueError:
+                errorDict[u"mqttPort"] = u"Port must be a number between 1 and 65535"
+
         if len(errorDict) > 0:
             return (False, valuesDict, errorDict)
         return (True, valuesDict)
@@ -239,6 +724,13 @@ class Plugin(indigo.PluginBase):
                 self.logLevel = logging.INFO
             self.indigo_log_handler.setLevel(self.logLevel)
             self.logger.debug(u"WeatherLink Live logLevel = " + str(self.logLevel))
+            for shard in self.shards.values():
+                shard.setLogLevel(self.logLevel)
+            self.compileConversions(valuesDict)
+            self.configureHistory(valuesDict)
+            self.configureLocalAPI(valuesDict)
+            self.configureMQTT(valuesDict)
+            self.perfStates = valuesDict.get("perfStates", False)
 
 
     ########################################
@@ -260,23 +752,34 @@ class Plugin(indigo.PluginBase):
             self.logger.warning(u"{}: Invalid device version: {}".format(device.name, instanceVers))
 
         device.stateListOrDisplayStateIdChanged()
+        self.stateCache.forget(device.id)
                 
         if device.deviceTypeId == "weatherlink":
  
-            self.weatherlinks[device.id] = WeatherLink(device)
-            device.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
+            link = WeatherLink(device, self.stateCache)
+            self.weatherlinks[device.id] = link
+            if self.shardStations:
+                self.shards[device.id] = StationShard(link, self.logLevel, self.perfStats)
+            self.udpRoutes = {}
+            self.scheduleLink(link)
+            self.stateCache.updateImage(device, indigo.kStateImageSel.SensorOn)
             
         elif device.deviceTypeId == "aprs_sender":
  
             self.senders[device.id] = APRS(device)
+            self.scheduleSender(self.senders[device.id])
             
         elif device.deviceTypeId == "pws_sender":
  
             self.senders[device.id] = PWS(device)
+            self.scheduleSender(self.senders[device.id])
             
         elif device.deviceTypeId == "wu_sender":
  
             self.senders[device.id] = WU(device)
+            self.scheduleSender(self.senders[device.id])
+            if self.senders[device.id].rapid_fire:
+                self.rapidSenders[device.id] = self.senders[device.id]
             
         elif device.deviceTypeId in ['issSensor', 'moistureSensor', 'tempHumSensor', 'baroSensor']:
 
@@ -301,6 +804,7 @@ class Plugin(indigo.PluginBase):
                 device.updateStateImageOnServer(indigo.kStateImageSel.Auto)
 
             self.sensorDevices[device.id] = device
+            self.indexSensor(device)
 
         else:
             self.logger.warning(u"{}: Invalid device type: {}".format(device.name, device.deviceTypeId))
@@ -308,22 +812,56 @@ class Plugin(indigo.PluginBase):
         if not device.pluginProps.get("pollingRounding", False):
             # Only do intial update if Polling Frequency rounding not in effect
             self.updateNeeded = True
+        self.wakeLoop()
         self.logger.debug(u"{}: deviceStartComm complete, sensorDevices = {}".format(device.name, self.sensorDevices))
 
             
     
     def deviceStopComm(self, device):
         self.logger.debug(u"{}: Stopping Device".format(device.name))
+        self.stateCache.forget(device.id)
         if device.deviceTypeId == "weatherlink":
             del self.weatherlinks[device.id]
+            shard = self.shards.pop(device.id, None)
+            if shard:
+                shard.stop()
+            for job in ['poll', 'real_time', 'gap']:
+                self.scheduler.cancel((job, device.id))
+            self.udpRoutes = {}
+            if not self.weatherlinks:
+                for listener in self.listeners.values():
+                    listener.stop()
+                self.listeners = {}
         elif device.deviceTypeId in ["aprs_sender", "pws_sender", "wu_sender"]:
             del self.senders[device.id]
+            self.rapidSenders.pop(device.id, None)
+            self.scheduler.cancel(('upload', device.id))
+            self.scheduler.cancel(('backfill', device.id))
         else:
             del self.sensorDevices[device.id]
+            self.unindexSensor(device.id)
 
         self.logger.debug(u"{}: deviceStopComm complete, sensorDevices = {}".format(device.name, self.sensorDevices))
             
             
+    def deviceUpdated(self, origDev, newDev):
+        indigo.PluginBase.deviceUpdated(self, origDev, newDev)
+        
+        if newDev.id in self.sensorDevices and origDev.address != newDev.address:
+            self.logger.debug(u"{}: Sensor address changed: {} -> {}".format(newDev.name, origDev.address, newDev.address))
+            self.sensorDevices[newDev.id] = newDev
+            self.unindexSensor(newDev.id)
+            self.indexSensor(newDev)
+            
+    def indexSensor(self, device):
+        self.sensorsByLsid.setdefault(device.address, []).append(device)
+
+    def unindexSensor(self, deviceId):
+        for lsid, sensorDevs in self.sensorsByLsid.items():
+            sensorDevs[:] = [dev for dev in sensorDevs if dev.id != deviceId]
+            if not sensorDevs:
+                del self.sensorsByLsid[lsid]
+                        
     def getDeviceDisplayStateId(self, device):
             
         try:
@@ -386,6 +924,25 @@ class Plugin(indigo.PluginBase):
         return retList
 
 
+    ########################################
+    # Action Methods
+    ########################################
+
+    def queryHistoryAction(self, pluginAction, device, callerWaitingForResult=False):
+        # Returns [ts, value] rows, or [ts, avg, min, max] rows when an interval (seconds) is given
+        
+        if not self.history:
+            self.logger.error(u"{}: Query History failed, sensor history is not enabled".format(device.name))
+            return None
+
+        props = pluginAction.props
+        end = float(props.get("end", 0)) or time.time()
+        start = float(props.get("start", 0)) or end - 24 * 60 * 60
+        rows = self.history.query(device.address, props.get("key", "temp"), start, end, int(props.get("interval", 0)))
+        self.logger.debug(u"{}: Query History returned {} rows".format(device.name, len(rows)))
+        return rows
+
+
     ########################################
     # Menu Methods
     ########################################
@@ -397,13 +954,97 @@ class Plugin(indigo.PluginBase):
             self.logger.error(u"Bad Device specified for Clear SMTP Queue operation")
             return False
 
-        for linkID, link in self.weatherlinks.items():
-            if linkID == deviceId:
-                self.processConditions(link.http_poll())            
+        link = self.weatherlinks.get(deviceId)
+        if link:
+            self.scheduler.schedule(('poll', link.device.id), time.time())
+            self.wakeLoop()
         return True
   
     def dumpKnownDevices(self):
         self.logger.info(u"Known device list:\n" + str(self.knownDevices))
+
+    def recordingPath(self):
+        return u"{}/Preferences/Plugins/{}/replay.json".format(indigo.server.getInstallFolderPath(), self.pluginId)
+
+    def saveRecordedTraffic(self):
+        path = self.recordingPath()
+        try:
+            saveRecording(path, list(self.recorded))
+        except Exception as err:
+            self.logger.error(u"Unable to save recorded traffic to {}: {}".format(path, err))
+            return
+        self.logger.info(u"Saved {} recorded packets to {}".format(len(self.recorded), path))
+
+    def benchmarkMenu(self, valuesDict, typeId):
+        try:
+            stations = int(valuesDict.get("stations", "1"))
+            passes = int(valuesDict.get("passes", "10"))
+            rate = float(valuesDict.get("rate", "0"))
+        except ValueError:
+            self.logger.error(u"Bad value specified for Benchmark Recorded Traffic")
+            return False
+
+        if self.benchmark and self.benchmark.is_alive():
+            self.logger.error(u"A benchmark is already running")
+            return False
+
+        packets = list(self.recorded)
+        if not packets:
+            try:
+                packets = loadRecording(self.recordingPath())
+            except Exception as err:
+                self.logger.error(u"No recorded traffic to replay: {}".format(err))
+                return False
+
+        # Run on its own thread, a paced replay can take far longer than a menu callback should
+        self.benchmark = threading.Thread(target=self.runBenchmark, name="benchmark", args=(packets, stations, passes, rate))
+        self.benchmark.daemon = True
+        self.benchmark.start()
+        self.logger.info(u"Benchmark started, replaying {} packets".format(len(packets) * passes * stations))
+        return True
+
+    def runBenchmark(self, packets, stations, passes, rate):
+        try:
+            results = ReplayBenchmark(self.conditionRecord, packets).run(stations, passes, rate)
+        except Exception as err:
+            self.logger.error(u"Benchmark error: {}".format(err))
+            return
+        self.logger.info(u"Replayed {packets} packets in {elapsed:.2f} sec: {packets_per_sec:.0f} packets/sec, latency p50 {p50_ms:.2f} ms, "
+                         u"p95 {p95_ms:.2f} ms, p99 {p99_ms:.2f} ms, max {max_ms:.2f} ms, {server_calls} server calls, "
+                         u"{states_sent} states sent, {states_skipped} unchanged states skipped".format(**results))
+
+    def dumpStateStats(self):
+        self.logger.info(u"State update statistics: " + self.stateCache.stats())
+
+    def dumpPerfStats(self):
+        self.logger.info(self.perfStats.report() + u"\n    " + self.stateCache.stats())
+
+    def resetPerfStats(self):
+        self.perfStats.reset()
+        self.logger.info(u"Performance statistics reset")
+
+    def startProfilerMenu(self, valuesDict, typeId):
+        try:
+            seconds = float(valuesDict.get("duration", "60"))
+        except ValueError:
+            self.logger.error(u"Bad value specified for Start Profiler")
+            return False
+
+        if self.profiler:
+            self.logger.warning(u"Profiler is already running")
+            return False
+            
+        self.profiler = LoopProfiler(indigo.server.getLogsFolderPath(pluginId=self.pluginId), seconds)
+        self.wakeLoop()
+        return True
+
+    def stopProfilerMenu(self):
+        if not self.profiler:
+            self.logger.info(u"Profiler is not running")
+            return
+        self.profiler.stop_at = 0.0
+        self.scheduler.schedule(('profiler', None), 0.0)
+        self.wakeLoop()
         
     # doesn't do anything, just needed to force other menus to dynamically refresh
     def menuChanged(self, valuesDict, typeId, devId):
@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import time
+import cProfile
+import pstats
+import logging
+from StringIO import StringIO
+
+################################################################################
+#
+#   cProfile session around the plugin's concurrent thread, started and stopped
+#   from the plugin menu.  cProfile only sees the thread that enabled it, so
+#   start() and stop() must be called from the concurrent thread itself.
+#   Nothing is installed while no session is running.
+#
+################################################################################
+
+kSummaryLines = 40      # functions listed in each section of the text summary
+
+
+class LoopProfiler(object):
+
+    def __init__(self, directory, seconds):
+        self.logger = logging.getLogger("Plugin.LoopProfiler")
+        self.directory = directory
+        self.seconds = seconds
+        self.profile = None
+        self.started = time.time()
+        self.stop_at = self.started + seconds
+
+    def start(self):
+        self.started = time.time()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.logger.info(u"Profiling concurrent thread for {} seconds".format(self.seconds))
+
+    def stop(self):
+        # Returns the paths of the .pstats file and the text summary
+
+        self.profile.disable()
+        elapsed = time.time() - self.started
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self.started)))
+        statsPath = base + ".pstats"
+        textPath = base + ".txt"
+
+        self.profile.dump_stats(statsPath)
+
+        summary = StringIO()
+        summary.write("Concurrent thread profile, {:.1f} seconds\n\n".format(elapsed))
+        stats = pstats.Stats(self.profile, stream=summary)
+        stats.strip_dirs()
+        stats.sort_stats('tottime').print_stats(kSummaryLines)
+        stats.sort_stats('cumulative').print_stats(kSummaryLines)
+        with open(textPath, "w") as text:
+            text.write(summary.getvalue())
+
+        self.profile = None
+        self.logger.info(u"Profile of {:.1f} seconds written to {} and {}".format(elapsed, statsPath, textPath))
+        return statsPath, textPath
@@ -10,6 +10,9 @@ import requests
 
 from datetime import datetime
 
+kUploadTimeout = 10.0       # seconds allowed for the upload request
+kBackfillAge = 7 * 24 * 60 * 60.0   # seconds an observation that couldn't be sent is kept, it's sent with its original dateutc
+
 class PWS(object):
 
     def __init__(self, device):
@@ -27,6 +30,11 @@ class PWS(object):
 
         self.updateFrequency = (float(self.device.pluginProps.get('updateFrequency', "10")) *  60.0)
         self.next_update = time.time()
+        self.upload_pending = False
+        self.backfill_age = kBackfillAge
+
+        URI = "/pwsupdate/pwsupdate.php"
+        self.url = "http://{}:{}/{}".format(self.server_host, self.server_port, URI)
 
         self.logger.debug(u"{}: PWS station_id = {}, server_host = {}, server_port = {}".format(self.device.name, self.address, self.server_host, self.server_port))
 
@@ -40,16 +48,14 @@ class PWS(object):
         self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorOff)
 
 
-    def send_update(self):
+    def start_update(self, readings):
+        # Runs on the concurrent thread, returns the data for send_update.  readings are from ConditionSnapshot, in US units.
 
         self.logger.info(u"{}: Sending Update".format(self.device.name))
 
         self.next_update = time.time() + self.updateFrequency
+        self.upload_pending = True
 
-        URI = "/pwsupdate/pwsupdate.php"
-        url = "http://{}:{}/{}".format(self.server_host, self.server_port, URI)
-        iss_device = indigo.devices[self.iss_device]
-        baro_device = indigo.devices[self.baro_device]
         data = {
             'ID': self.address,
             'PASSWORD': self.password,
@@ -57,43 +63,60 @@ class PWS(object):
             'action':'updateraw',
             'dateutc': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
         
-            'tempf': float(iss_device.states['temp']),
-            'dewptf': float(iss_device.states['dew_point']),
+            'tempf': readings['temp'],
+            'dewptf': readings['dew_point'],
 
-            'baromin': float(baro_device.states['bar_sea_level']),
-            'humidity': float(iss_device.states['hum']),
+            'baromin': readings['bar_sea_level'],
+            'humidity': readings['hum'],
 
-            'rainin': float(iss_device.states['rain_60_min']),
-            'dailyrainin': float(iss_device.states['rainfall_daily']),
-            'monthrainin': float(iss_device.states['rainfall_monthly']),
-            'yearrainin': float(iss_device.states['rainfall_year']),
+            'rainin': readings['rain_60_min'],
+            'dailyrainin': readings['rainfall_daily'],
+            'monthrainin': readings['rainfall_monthly'],
+            'yearrainin': readings['rainfall_year'],
 
-            'windspeedmph': float(iss_device.states['wind_speed_avg_last_10_min']),
-            'windgustmph': float(iss_device.states['wind_speed_hi_last_10_min']),
-            'winddir': float(iss_device.states['wind_dir_scalar_avg_last_10_min']),
+            'windspeedmph': readings['wind_speed_avg_last_10_min'],
+            'windgustmph': readings['wind_speed_hi_last_10_min'],
+            'winddir': readings['wind_dir_scalar_avg_last_10_min'],
 
         }
         
-        self.logger.debug(u"{}: PWS upload data = {}".format(self.device.name,data))
-            
+        self.logger.debug(u"%s: PWS upload data = %s", self.device.name, data)
+
+        return data
+
+
+    def send_update(self, data):
+        # Runs on an upload worker thread, returns the resulting status
+
         try:
-            r = requests.get(url, params=data)
+            r = requests.get(self.url, params=data, timeout=kUploadTimeout)
         except Exception as err:
             self.logger.error(u"{}: send_update error: {}".format(self.device.name, err))
-            status = "Request Error"
-            stateImage = indigo.kStateImageSel.SensorTripped
+            return "Request Error"
+
+        if r.status_code >= 500:
+            self.logger.error(u"{}: send_update server error: {}".format(self.device.name, r.status_code))
+            return "Server Error"
+
+        if not r.text.find('Logged and posted') >= 0:
+            self.logger.error(u"{}: send_update error: {}".format(self.device.name, r.text))
+            return "Data Error"
+
+        self.logger.debug(u"%s: send_update complete", self.device.name)
+        return "OK"
+
+
+    def send_complete(self, status):
+        # Runs on the concurrent thread
+
+        self.upload_pending = False
+        if status == "OK":
+            stateImage = indigo.kStateImageSel.SensorOn
         else:
-            if not r.text.find('Logged and posted') >= 0:
-                self.logger.error(u"{}: send_update error: {}".format(self.device.name, r.text))
-                status = "Data Error"
-                stateImage = indigo.kStateImageSel.SensorTripped
-            else:
-                self.logger.debug(u"{}: send_update complete".format(self.device.name))
-                status = "OK"
-                stateImage = indigo.kStateImageSel.SensorOn
+            stateImage = indigo.kStateImageSel.SensorTripped
 
         stateList = [
-            { 'key':'status',   'value':  status},
+            { 'key':'status',   'value':  status or "Request Error"},
             { 'key':'timestamp','value':  datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
         ]
         self.device.updateStatesOnServer(stateList)
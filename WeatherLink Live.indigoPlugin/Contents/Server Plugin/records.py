@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+################################################################################
+#
+#   Converted states of one WLL condition, as parallel lists in a __slots__
+#   object instead of a four-key dict per state.  Most states don't change from
+#   one packet to the next, so Indigo's state dicts are only built by
+#   StateCache, for the states that are actually pushed to the server.
+#
+################################################################################
+
+class StateRecord(object):
+
+    __slots__ = ('keys', 'values', 'uiValues', 'decimalPlaces')
+
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.uiValues = []          # None for states shown as their raw value
+        self.decimalPlaces = []     # None for states shown as their raw value
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, value, uiValue=None, decimalPlaces=None):
+        self.keys.append(key)
+        self.values.append(value)
+        self.uiValues.append(uiValue)
+        self.decimalPlaces.append(decimalPlaces)
+
+    def state(self, index):
+        # Indigo's state dict for one entry, as passed to updateStatesOnServer()
+
+        state = {'key': self.keys[index], 'value': self.values[index]}
+        if self.uiValues[index] is not None:
+            state['uiValue'] = self.uiValues[index]
+            state['decimalPlaces'] = self.decimalPlaces[index]
+        return state
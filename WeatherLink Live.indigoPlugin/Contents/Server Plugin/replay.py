@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import time
+import json
+
+from statecache import StateCache
+from aggregates import AggregateEngine
+
+################################################################################
+#
+#   Replays recorded condition packets through the plugin's conversion and
+#   state update path, against stand-in devices that count server calls
+#   instead of making them, to measure hot path throughput.
+#
+################################################################################
+
+class CountingDevice(object):
+    # Stands in for an Indigo sensor device
+
+    def __init__(self, deviceId, name):
+        self.id = deviceId
+        self.name = name
+        self.calls = 0
+        self.states = 0
+
+    def updateStatesOnServer(self, stateList):
+        self.calls += 1
+        self.states += len(stateList)
+
+
+def loadRecording(path):
+    with open(path, "r") as recording:
+        return json.load(recording)
+
+
+def saveRecording(path, packets):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "w") as recording:
+        json.dump(packets, recording)
+
+
+class ReplayBenchmark(object):
+
+    def __init__(self, conditionRecord, packets):
+        self.conditionRecord = conditionRecord
+        self.packets = packets      # list of condition lists, as returned by udp_process/http_poll_complete
+
+    def run(self, stations=1, passes=1, rate=0.0):
+        # Each simulated station gets its own devices, state cache and aggregates, like a separate WeatherLink
+
+        lsids = set(str(condition['lsid']) for packet in self.packets for condition in packet)
+        sims = []
+        for station in range(stations):
+            devices = dict((lsid, CountingDevice(station * 1000 + i, u"{}-{}".format(station, lsid))) for i, lsid in enumerate(sorted(lsids)))
+            sims.append((devices, StateCache(), AggregateEngine()))
+
+        latencies = []
+        interval = 1.0 / rate if rate else 0.0
+        start = time.time()
+        next_packet = start
+        for i in range(passes):
+            for packet in self.packets:
+                for devices, stateCache, aggregates in sims:
+                    if interval:
+                        delay = next_packet - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+                        next_packet += interval
+
+                    began = time.time()
+                    for condition in packet:
+                        lsid = str(condition['lsid'])
+                        record = self.conditionRecord(lsid, condition, began, aggregates)
+                        stateCache.updateRecord(devices[lsid], record)
+                    latencies.append(time.time() - began)
+        elapsed = time.time() - start
+
+        latencies.sort()
+        count = len(latencies)
+        calls = sum(device.calls for devices, stateCache, aggregates in sims for device in devices.values())
+        states = sum(device.states for devices, stateCache, aggregates in sims for device in devices.values())
+        return {
+            'packets':          count,
+            'elapsed':          elapsed,
+            'packets_per_sec':  count / elapsed if elapsed else 0.0,
+            'p50_ms':           latencies[count // 2] * 1000.0 if count else 0.0,
+            'p95_ms':           latencies[min(count - 1, int(count * 0.95))] * 1000.0 if count else 0.0,
+            'p99_ms':           latencies[min(count - 1, int(count * 0.99))] * 1000.0 if count else 0.0,
+            'max_ms':           latencies[-1] * 1000.0 if count else 0.0,
+            'server_calls':     calls,
+            'states_sent':      states,
+            'states_skipped':   sum(stateCache.skipped for devices, stateCache, aggregates in sims),
+        }
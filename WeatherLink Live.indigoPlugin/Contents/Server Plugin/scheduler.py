@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import time
+import heapq
+import threading
+
+################################################################################
+#
+#   Timer heap for the concurrent thread.  Each timed job is registered under a
+#   key such as ('poll', device.id); scheduling a key again replaces its due
+#   time, and superseded heap entries are discarded lazily when they surface.
+#   Device callbacks run on other threads, so the heap is locked.
+#
+################################################################################
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []          # (due, sequence, key), may hold superseded entries
+        self.due = {}           # current due time, indexed by key
+        self.sequence = 0       # tie breaker, so keys are never compared
+
+    def schedule(self, key, due):
+        with self.lock:
+            if self.due.get(key) == due:
+                return
+            self.due[key] = due
+            self.sequence += 1
+            heapq.heappush(self.heap, (due, self.sequence, key))
+
+    def cancel(self, key):
+        with self.lock:
+            self.due.pop(key, None)
+
+    def scheduled(self, key):
+        return self.due.get(key)
+
+    def discardStale(self):
+        while self.heap:
+            due, sequence, key = self.heap[0]
+            if self.due.get(key) == due:
+                return
+            heapq.heappop(self.heap)
+
+    def timeout(self):
+        # Seconds until the next job is due, or None if nothing is scheduled
+        with self.lock:
+            self.discardStale()
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - time.time())
+
+    def popDue(self):
+        # Removes and returns the keys of all jobs that are due, earliest first
+        now = time.time()
+        keys = []
+        with self.lock:
+            while True:
+                self.discardStale()
+                if not self.heap or self.heap[0][0] > now:
+                    return keys
+                due, sequence, key = heapq.heappop(self.heap)
+                del self.due[key]
+                keys.append(key)
@@ -0,0 +1,317 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import time
+import errno
+import select
+import socket
+import logging
+import multiprocessing
+
+import decoder
+
+################################################################################
+#
+#   Optional per-station worker processes.  Each WeatherLink's HTTP requests,
+#   UDP reception and JSON decoding run in its own process, so stations don't
+#   share the GIL and a station that hangs or floods can't hold up the others.
+#   Lease scheduling, routing and every Indigo call stay in the plugin process.
+#
+#   Conditions come back over a pipe as deltas: the first condition of each
+#   (lsid, key set) shape is sent in full, after that only the readings that
+#   changed.  The plugin side rebuilds each condition exactly as the WLL sent
+#   it, so nothing downstream can tell a shard from a local poll.
+#
+#   Request and decode timings are measured in the shard and sent back with
+#   the results, so the plugin's perf stats cover sharded stations too.
+#
+#   The shard process is forked after the plugin has started threads, so it
+#   never touches Indigo, and its logging goes back over the pipe rather than
+#   through handlers that may have been mid-write when it was forked.
+#
+################################################################################
+
+kReceiveSize = 2048         # largest broadcast datagram
+kStopWait = 2.0             # seconds a shard process is given to exit before it's terminated
+
+
+class DeltaEncoder(object):
+
+    def __init__(self):
+        self.shapes = {}            # shape id, indexed by (lsid, frozenset of keys)
+        self.last = {}              # readings last sent, indexed by shape id
+
+    def encode(self, conditions):
+        # Returns [(shape id, readings)] with all readings for a new shape, otherwise only those that changed
+
+        deltas = []
+        for condition in conditions:
+            shape = (condition.get('lsid'), frozenset(condition))
+            shapeId = self.shapes.get(shape)
+            if shapeId is None:
+                shapeId = self.shapes[shape] = len(self.shapes)
+                self.last[shapeId] = dict(condition)
+                deltas.append((shapeId, condition))
+                continue
+            last = self.last[shapeId]
+            changed = dict((key, value) for key, value in condition.iteritems() if last[key] != value)
+            last.update(changed)
+            deltas.append((shapeId, changed))
+        return deltas
+
+
+class DeltaDecoder(object):
+
+    def __init__(self):
+        self.last = {}              # complete condition, indexed by shape id
+
+    def decode(self, deltas):
+        conditions = []
+        for shapeId, readings in deltas:
+            condition = self.last.get(shapeId)
+            if condition is None:
+                condition = self.last[shapeId] = dict(readings)
+            else:
+                condition.update(readings)
+            conditions.append(dict(condition))
+        return conditions
+
+
+class PipeLogHandler(logging.Handler):
+    # Sends the shard process's log messages to the plugin process, which logs them
+
+    def __init__(self, conn, level):
+        logging.Handler.__init__(self, level)
+        self.conn = conn
+
+    def emit(self, record):
+        try:
+            self.conn.send(('log', record.levelno, self.format(record)))
+        except Exception:
+            pass
+
+
+################################################################################
+#
+#   Runs in the shard process
+#
+################################################################################
+
+def shardMain(conn, parentConn, client, ip_address, pluginLogger, logLevel):
+
+    parentConn.close()      # so the pipe reads as closed here once the plugin process goes away
+    pluginLogger.handlers = [PipeLogHandler(conn, logLevel)]
+    pluginLogger.propagate = False
+
+    encoder = DeltaEncoder()
+    did = None                  # the station's did, as bytes for matching undecoded packets
+    sock = None
+
+    while True:
+        readable = select.select([conn, sock] if sock else [conn], [], [])[0]
+
+        if conn in readable:
+            try:
+                command = conn.recv()
+            except EOFError:
+                return
+
+            if command[0] == 'stop':
+                return
+            elif command[0] == 'poll':
+                began = time.time()
+                status, json_data = client.http_poll()
+                elapsed = time.time() - began
+                if status == 'OK':
+                    did = str(json_data['data']['did'])
+                    conn.send(('poll', elapsed, status, json_data['data']['did'], json_data['data']['ts'], encoder.encode(json_data['data']['conditions'])))
+                else:
+                    conn.send(('poll', elapsed, status, None, None, None))
+            elif command[0] == 'real_time':
+                began = time.time()
+                result = client.udp_start()
+                conn.send(('real_time', time.time() - began, result))
+            elif command[0] == 'listen':
+                if sock:
+                    sock.close()
+                sock = shardSocket(client.name, command[1], pluginLogger)
+            elif command[0] == 'log_level':
+                pluginLogger.handlers[0].setLevel(command[1])
+
+        if sock in readable:
+            while True:
+                try:
+                    data, addr = sock.recvfrom(kReceiveSize)
+                except socket.error as err:
+                    if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        pluginLogger.error(u"{}: shard receive error: {}".format(client.name, err))
+                    break
+
+                # Every station broadcasts to the same port, skip other stations' packets before decoding them.
+                # Stations can share an address, so once the did is known it decides.
+                if did:
+                    if did not in data:
+                        continue
+                elif addr[0] != ip_address:
+                    continue
+
+                began = time.time()
+                try:
+                    json_data = decoder.loads(data)
+                except Exception as err:
+                    pluginLogger.error(u"{}: shard JSON decode error: {}".format(client.name, err))
+                    conn.send(('udp_error', time.time() - began))
+                    continue
+                elapsed = time.time() - began
+                if did and str(json_data['did']) != did:
+                    continue
+                did = str(json_data['did'])
+                conn.send(('udp', elapsed, json_data['did'], json_data['ts'], encoder.encode(json_data['conditions'])))
+
+
+def shardSocket(name, port, logger):
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(0)
+        sock.bind(('', port))
+    except socket.error as err:
+        logger.error(u"{}: shard listen error on port {}: {}".format(name, port, err))
+        return None
+    return sock
+
+
+################################################################################
+#
+#   Runs in the plugin process
+#
+################################################################################
+
+class StationShard(object):
+
+    def __init__(self, link, logLevel, perfStats):
+        self.logger = logging.getLogger("Plugin.StationShard")
+        self.link = link
+        self.logLevel = logLevel
+        self.perfStats = perfStats
+        self.process = None
+        self.conn = None
+        self.port = None            # broadcast port the shard listens on, restored if the process is restarted
+        self.pending = None         # 'poll' or 'real_time' while a request is outstanding
+        self.start()
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=shardMain, name=u"shard-{}".format(self.link.device.id),
+                                               args=(child, self.conn, self.link.client, self.link.ip_address, logging.getLogger("Plugin"), self.logLevel))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.decoder = DeltaDecoder()
+        self.logger.debug(u"{}: shard process {} started".format(self.link.device.name, self.process.pid))
+        if self.port:
+            self.conn.send(('listen', self.port))
+
+    def stop(self):
+        if self.conn:
+            try:
+                self.conn.send(('stop',))
+            except Exception:
+                pass
+            self.conn.close()
+            self.conn = None
+        self.process.join(kStopWait)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def closed(self):
+        # The process died or its pipe broke, it's restarted on the next request
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(kStopWait)
+
+    def send(self, command):
+        # Returns False if the command couldn't be sent, even after restarting the process
+        for attempt in range(2):
+            try:
+                if not self.conn:
+                    self.logger.warning(u"{}: restarting shard process, previous one exited with code {}".format(self.link.device.name, self.process.exitcode))
+                    self.start()
+                self.conn.send(command)
+                return True
+            except (IOError, EOFError, OSError) as err:
+                self.logger.error(u"{}: shard process send error: {}".format(self.link.device.name, err))
+                if self.conn:
+                    self.closed()
+        return False
+
+    def poll(self):
+        # Returns False if the request couldn't be made, in which case it's complete and failed
+        self.pending = 'poll'
+        if self.send(('poll',)):
+            return True
+        self.pending = None
+        return False
+
+    def realTime(self):
+        # Returns False if the request couldn't be made, in which case it's complete and failed
+        self.pending = 'real_time'
+        if self.send(('real_time',)):
+            return True
+        self.pending = None
+        return False
+
+    def listen(self, port):
+        if port and port != self.port:
+            self.port = port
+            self.send(('listen', port))
+
+    def setLogLevel(self, level):
+        self.logLevel = level
+        self.send(('log_level', level))
+
+    def receive(self):
+        # Returns the shard's pending messages as [(kind, result)], with conditions rebuilt in the WLL's own format
+
+        messages = []
+        while self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                # The process died, complete any outstanding request so the link reschedules, and restart on the next request
+                self.logger.error(u"{}: shard process stopped unexpectedly".format(self.link.device.name))
+                if self.pending:
+                    messages.append((self.pending, None))
+                    self.pending = None
+                self.closed()
+                break
+
+            if message[0] == 'log':
+                self.logger.log(message[1], message[2])
+            elif message[0] == 'poll':
+                self.pending = None
+                elapsed, status, did, ts, deltas = message[1:]
+                self.perfStats.record('http_poll', self.link.device.name, elapsed)
+                if status == 'OK':
+                    json_data = {'data': {'did': did, 'ts': ts, 'conditions': self.decoder.decode(deltas)}, 'error': None}
+                    messages.append(('poll', (status, json_data)))
+                else:
+                    messages.append(('poll', (status, None)))
+            elif message[0] == 'real_time':
+                self.pending = None
+                self.perfStats.record('real_time', self.link.device.name, message[1])
+                messages.append(('real_time', message[2]))
+            elif message[0] == 'udp':
+                elapsed, did, ts, deltas = message[1:]
+                self.perfStats.record('json_decode', u"port {}".format(self.port), elapsed)
+                messages.append(('udp', {'did': did, 'ts': ts, 'conditions': self.decoder.decode(deltas)}))
+            elif message[0] == 'udp_error':
+                self.perfStats.record('json_decode', u"port {}".format(self.port), message[1])
+                messages.append(('udp', None))
+        return messages
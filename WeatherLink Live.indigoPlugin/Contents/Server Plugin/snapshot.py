@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+from conversions import kRainCollector, kRenamedStates
+
+################################################################################
+#
+#   Latest raw (unconverted) ISS and barometer readings, merged across HTTP
+#   polls and UDP broadcasts, for the weather network senders.  The networks all
+#   want US units, which is what the WLL reports except for rain, so uploads
+#   don't depend on the plugin's display units or on Indigo device states.
+#
+################################################################################
+
+kMillimetersPerInch = 25.4
+
+kSnapshotStates = ['temp', 'dew_point', 'hum', 'bar_sea_level',
+                   'wind_speed_last', 'wind_dir_last', 'wind_speed_hi_last_2_min', 'wind_dir_at_hi_speed_last_2_min',
+                   'wind_speed_avg_last_10_min', 'wind_speed_hi_last_10_min',
+                   'wind_dir_scalar_avg_last_10_min', 'wind_dir_at_hi_speed_last_10_min']
+kSnapshotRainStates = ['rain_60_min', 'rain_24_hr', 'rainfall_daily', 'rainfall_monthly', 'rainfall_year']
+
+# WLL keys kept, mapped to the name they're kept under
+kTrackedKeys = dict((key, key) for key in kSnapshotStates + kSnapshotRainStates + ['rain_size'])
+kTrackedKeys.update((raw, key) for raw, key in kRenamedStates.items() if key in kTrackedKeys)
+
+
+class ConditionSnapshot(object):
+
+    def __init__(self):
+        self.conditions = {}        # raw readings, indexed by lsid then WLL key (after kRenamedStates)
+        self.cache = {}             # result of readings(), indexed by (iss lsid, baro lsid), until the next update
+
+    def update(self, lsid, condition):
+        current = self.conditions.get(lsid)
+        if current is None:
+            current = self.conditions[lsid] = {}
+        for raw, key in kTrackedKeys.iteritems():
+            if raw in condition:
+                current[key] = condition[raw] or 0       # null readings are reported as 0, like the device states
+        self.cache = {}
+
+    def readings(self, issLsid, baroLsid):
+        # Returns the sender fields in °F, %, mph, degrees, inHg and inches, or None until both sensors have reported
+
+        key = (issLsid, baroLsid)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        iss = self.conditions.get(issLsid)
+        baro = self.conditions.get(baroLsid)
+        if not iss or not baro:
+            return None
+
+        result = dict((state, float(iss[state])) for state in kSnapshotStates if state in iss)
+        if 'bar_sea_level' in baro:
+            result['bar_sea_level'] = float(baro['bar_sea_level'])
+
+        factor, units = kRainCollector.get(iss.get('rain_size', 1), (None, None))     # same default as sensorDictToRecord
+        if factor:
+            if units == "mm":
+                factor = factor / kMillimetersPerInch
+            for state in kSnapshotRainStates:
+                if state in iss:
+                    result[state] = float(iss[state]) * factor
+
+        self.cache[key] = result
+        return result
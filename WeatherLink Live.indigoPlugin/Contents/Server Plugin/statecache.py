@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import thread
+from itertools import izip, count
+from collections import OrderedDict
+
+################################################################################
+#
+#   Remembers the last value/uiValue pushed for each device state, and the last
+#   state image, so only what actually changed is sent to the Indigo server.
+#
+#   Between begin() and commit() changes are collected instead of sent, so a
+#   poll or broadcast that touches the same device more than once costs one
+#   updateStatesOnServer() per device.  commit() sends every device's states
+#   before any state images, so triggers on one device see the other devices
+#   already updated from the same packet.
+#
+#   The batch belongs to the thread that opened it.  Indigo's callback threads
+#   (deviceStartComm, deviceStopComm) still go through the cache, but their
+#   changes are sent straight away, so they can't land in a batch that has
+#   already been committed.
+#
+################################################################################
+
+class StateCache(object):
+
+    def __init__(self):
+        self.lastStates = {}        # Dict of {key: (value, uiValue)}, indexed by device.id
+        self.lastImages = {}        # Dict of the state image last set, indexed by device.id
+        self.batch = None           # OrderedDict of [device, {key: state}, image] while a batch is open, indexed by device.id
+        self.owner = None           # thread id that opened the batch
+        self.sent = 0               # states pushed to the server
+        self.skipped = 0            # states not pushed because they were unchanged
+        self.calls = 0              # updateStatesOnServer() and updateStateImageOnServer() calls made
+
+    def updateStates(self, device, stateList):
+
+        last = self.lastStates.setdefault(device.id, {})
+        changed = []
+        for state in stateList:
+            if last.get(state['key']) != (state['value'], state.get('uiValue')):
+                changed.append(state)
+
+        self.skipped += len(stateList) - len(changed)
+        if changed:
+            self.push(device, changed, last)
+        return changed
+
+    def updateRecord(self, device, record):
+        # Same as updateStates() for a StateRecord, only the changed states are turned into state dicts
+
+        last = self.lastStates.setdefault(device.id, {})
+        changed = [record.state(index) for index, key, value, uiValue in izip(count(), record.keys, record.values, record.uiValues)
+                   if last.get(key) != (value, uiValue)]
+
+        self.skipped += len(record.keys) - len(changed)
+        if changed:
+            self.push(device, changed, last)
+        return changed
+
+    def updateImage(self, device, image):
+        if self.lastImages.get(device.id) == image:
+            return
+        batch = self.currentBatch()
+        if batch is not None:
+            self.batched(batch, device)[2] = image
+        else:
+            device.updateStateImageOnServer(image)
+            self.calls += 1
+        self.lastImages[device.id] = image
+
+    def push(self, device, changed, last):
+        batch = self.currentBatch()
+        if batch is not None:
+            states = self.batched(batch, device)[1]
+            for state in changed:
+                states[state['key']] = state        # a later change to the same state in the batch replaces the earlier one
+        else:
+            device.updateStatesOnServer(changed)
+            self.sent += len(changed)
+            self.calls += 1
+        for state in changed:
+            last[state['key']] = (state['value'], state.get('uiValue'))
+
+    def currentBatch(self):
+        # The open batch if this thread opened it, otherwise None and changes are sent directly
+        if self.owner == thread.get_ident():
+            return self.batch
+        return None
+
+    def batched(self, batch, device):
+        entry = batch.get(device.id)
+        if entry is None:
+            entry = batch[device.id] = [device, {}, None]
+        return entry
+
+    def begin(self):
+        self.batch = OrderedDict()
+        self.owner = thread.get_ident()
+
+    def commit(self):
+        batch, self.batch, self.owner = self.batch, None, None
+        try:
+            for device, states, image in batch.itervalues():
+                if states:
+                    device.updateStatesOnServer(states.values())
+                    self.sent += len(states)
+                    self.calls += 1
+            for device, states, image in batch.itervalues():
+                if image is not None:
+                    device.updateStateImageOnServer(image)
+                    self.calls += 1
+        except Exception:
+            # Some of the batch may not have reached the server, so don't let the cache skip those values next time
+            for deviceId in batch:
+                self.forget(deviceId)
+            raise
+
+    def forget(self, deviceId):
+        self.lastStates.pop(deviceId, None)
+        self.lastImages.pop(deviceId, None)
+
+    def stats(self):
+        return u"states sent = {}, states skipped (unchanged) = {}, server calls = {}".format(self.sent, self.skipped, self.calls)
@@ -15,20 +15,123 @@ except ImportError:
 from datetime import datetime
 import time
 import socket
-import json
 import logging
 
+import decoder
+
+kLeaseDuration = 1200       # seconds of UDP broadcasts requested from /v1/real_time
+kRenewMargin = 30.0         # seconds before the lease expires to request a new one
+kBroadcastGap = 15.0        # seconds without a broadcast (sent every 2.5 sec) before renewing early
+kMaxGapRetry = 600.0        # longest wait between early renewals while no broadcasts arrive
+
+################################################################################
+#
+#   The WLL's HTTP API, kept apart from the Indigo device so it can also be
+#   used from a station's shard process.
+#
+################################################################################
+
+class WeatherLinkClient(object):
+
+    def __init__(self, name, address, http_port, enableUDP):
+        self.logger = logging.getLogger("Plugin.WeatherLink")
+        self.name = name
+        self.address = address
+        self.http_port = http_port
+        self.enableUDP = enableUDP
+        self.session = requests.Session()
+
+    def close(self):
+        self.session.close()
+
+
+    def udp_start(self):
+        # Runs on a worker thread or shard process, returns (status, broadcast port, lease duration)
+    
+        if not self.enableUDP:
+            self.logger.debug(u"%s: udp_start() aborting, not enabled", self.name)
+            return None, None, None
+        
+        url = "http://{}:{}/v1/real_time?duration={}".format(self.address, self.http_port, kLeaseDuration)
+        try:
+            response = self.session.get(url, timeout=3.0)
+        except requests.exceptions.RequestException as err:
+            self.logger.error(u"{}: udp_start() RequestException: {}".format(self.name, err))
+            return 'HTTP Error', None, None
+
+        try:
+            json_data = decoder.loads(response.content)
+        except Exception as err:
+            self.logger.error(u"{}: udp_start() JSON decode error: {}".format(self.name, err))
+            return 'JSON Error', None, None
+            
+        if json_data['error']:
+            if json_data['error']['code'] == 409:
+                self.logger.debug(u"%s: udp_start() aborting, no ISS sensors", self.name)
+            else:
+                self.logger.error(u"{}: udp_start() error, code: {}, message: {}".format(self.name, json_data['error']['code'], json_data['error']['message']))
+            return 'Server Error', None, None
+
+        self.logger.debug(u"%s: udp_start() broadcast_port = %s, duration = %s", self.name, json_data['data']['broadcast_port'], json_data['data']['duration'])
+
+        return 'OK', int(json_data['data']['broadcast_port']), float(json_data['data'].get('duration') or kLeaseDuration)
+
+
+    def http_poll(self):
+        # Runs on a worker thread or shard process, returns (status, json data)
+        
+        url = "http://{}:{}/v1/current_conditions".format(self.address, self.http_port)
+        try:
+            response = self.session.get(url, timeout=3.0)
+        except requests.exceptions.RequestException as err:
+            self.logger.error(u"{}: http_poll RequestException: {}".format(self.name, err))
+            return 'HTTP Error', None
+
+        try:
+            json_data = decoder.loads(response.content)
+        except Exception as err:
+            self.logger.error(u"{}: http_poll JSON decode error: {}".format(self.name, err))
+            return 'JSON Error', None
+
+        self.logger.threaddebug("%s", response.content)
+            
+        if json_data['error']:
+            self.logger.error(u"{}: http_poll Bad return code: {}".format(self.name, json_data['error']))
+            return 'Server Error', None
+
+        return 'OK', json_data
+
+
 ################################################################################
 class WeatherLink(object):
 
-    def __init__(self, device):
+    def __init__(self, device, stateCache):
         self.logger = logging.getLogger("Plugin.WeatherLink")
         self.device = device
+        self.stateCache = stateCache
         
         self.address = device.pluginProps.get(u'address', "")
         self.http_port = int(device.pluginProps.get(u'port', 80))
         self.udp_port = None
-        self.sock = None
+        self.did = None
+        self.ts = None                  # WLL timestamp of the latest conditions, from either poll or broadcast
+
+        # HTTP requests run on the plugin's worker pool (or the station's shard process), one at a time per link
+        self.client = WeatherLinkClient(device.name, self.address, self.http_port, device.pluginProps['enableUDP'])
+        self.http_pending = False
+        self.next_udp_start = None      # when to request (or renew) broadcasts, None while not scheduled
+
+        # broadcast lease from the last successful real_time request, watched for gaps in the stream
+        self.lease_expires = 0.0
+        self.last_broadcast = 0.0
+        self.last_broadcast_ts = 0
+        self.gap_limit = kBroadcastGap
+
+        # broadcasts are matched to this link by sender address when the did isn't known yet
+        try:
+            self.ip_address = socket.gethostbyname(self.address)
+        except socket.error:
+            self.ip_address = self.address
 
         self.pollFrequency = float(self.device.pluginProps.get('pollingFrequency', "10")) * 60.0
 
@@ -40,13 +143,13 @@ class WeatherLink(object):
         
             
     def __del__(self):
-        self.sock.close()
+        self.client.close()
         stateList = [
             { 'key':'status',   'value':  "Off"},
             { 'key':'timestamp','value':  datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
         ]
-        self.device.updateStatesOnServer(stateList)
-        self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorOff)
+        self.stateCache.updateStates(self.device, stateList)
+        self.stateCache.updateImage(self.device, indigo.kStateImageSel.SensorOff)
 
     def calculateNextPollTime(self, class_init):
         if self.pollingRounding:
@@ -61,101 +164,68 @@ class WeatherLink(object):
 
 
     def udp_start(self):
-    
-        if not self.device.pluginProps['enableUDP']:
-            self.logger.debug(u"{}: udp_start() aborting, not enabled".format(self.device.name))
-            return
+        return self.client.udp_start()
+
+
+    def udp_start_complete(self, result):
+        # Runs on the concurrent thread, returns the port the plugin's shared listener should use
         
-        url = "http://{}:{}/v1/real_time".format(self.address, self.http_port)
-        try:
-            response = requests.get(url, timeout=3.0)
-        except requests.exceptions.RequestException as err:
-            self.logger.error(u"{}: udp_start() RequestException: {}".format(self.device.name, err))
-            stateList = [
-                { 'key':'status',   'value': 'HTTP Error'},
-            ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-            return
+        self.http_pending = False
+        status, port, duration = result or ('Error', None, None)
+        
+        if status is None:
+            return None
+        elif status != 'OK':
+            self.udp_error(status)
+            if time.time() < self.lease_expires:
+                self.next_udp_start = time.time() + kBroadcastGap    # failed renewal, retry while the lease lasts
+            return None
 
-        try:
-            json_data = response.json()
-        except Exception as err:
-            self.logger.error(u"{}: udp_start() JSON decode error: {}".format(self.device.name, err))
-            stateList = [
-                { 'key':'status',   'value':'JSON Error'},
-            ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-            return
-            
-        if json_data['error']:
-            if json_data['error']['code'] == 409:
-                self.logger.debug(u"{}: udp_start() aborting, no ISS sensors".format(self.device.name))
-            else:
-                self.logger.error(u"{}: udp_start() error, code: {}, message: {}".format(self.device.name, json_data['error']['code'], json_data['error']['message']))
-            stateList = [
-                { 'key':'status',   'value': 'Server Error'},
-            ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-            return
+        # renew just before the lease the WLL actually granted runs out, independent of the poll schedule
+        now = time.time()
+        self.lease_expires = now + duration
+        self.next_udp_start = now + max(duration - kRenewMargin, duration / 2.0)
+        self.last_broadcast = now
+        self.udp_port = port
+        return self.udp_port
 
-        self.logger.debug(u"{}: udp_start() broadcast_port = {}, duration = {}".format(self.device.name, json_data['data']['broadcast_port'], json_data['data']['duration']))
 
-        # set up socket listener
-        
-        if not self.sock:
-            try:
-                self.udp_port = int(json_data['data']['broadcast_port'])
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-                self.sock.settimeout(0.1)
-                self.sock.bind(('', self.udp_port))
-            except socket.error as err:
-                self.logger.error(u"{}: udp_start() RequestException: {}".format(self.device.name, err))
-                stateList = [
-                    { 'key':'status',   'value': 'Socket Error'},
-                ]
-                self.device.updateStatesOnServer(stateList)
-            else:
-                self.logger.debug(u"{}: udp_start() socket listener started".format(self.device.name))
+    def udp_gap_due(self):
+        # When the broadcast stream counts as stalled, or None if there's no active lease to watch
+        if self.next_udp_start and time.time() < self.lease_expires:
+            return self.last_broadcast + self.gap_limit
+        return None
 
 
-    def udp_receive(self):
+    def udp_gap_check(self, now):
+        # Runs on the concurrent thread, reschedules the renewal if the lease is active but broadcasts stopped
 
-        if not self.sock:
-            self.logger.threaddebug(u"{}: udp_receive error: no socket".format(self.device.name))
-            return
-            
-        try:
-            data, addr = self.sock.recvfrom(2048)
-        except socket.timeout, err:
-            return
-        except socket.error, err:
-            self.logger.error(u"{}: udp_receive socket error: {}".format(self.device.name, err))
-            stateList = [
-                { 'key':'status',   'value':'socket Error'},
-            ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-            return
+        if self.next_udp_start and now < self.lease_expires and now > self.last_broadcast + self.gap_limit:
+            self.logger.warning(u"{}: No broadcasts for {:.0f} seconds, renewing real_time request".format(self.device.name, now - self.last_broadcast))
+            self.next_udp_start = now
+            self.gap_limit = min(self.gap_limit * 2.0, kMaxGapRetry)     # back off if the WLL keeps not sending
 
-        try:
-            raw_data = data.decode("utf-8")
-            self.logger.threaddebug("{}".format(raw_data))
-            json_data = json.loads(raw_data)        
-        except Exception as err:
-            self.logger.error(u"{}: udp_receive JSON decode error: {}".format(self.device.name, err))
-            stateList = [
-                { 'key':'status',   'value':'JSON Error'},
-            ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-            return
-            
-        self.logger.threaddebug(u"{}: udp_receive success: did = {}, ts = {}, {} conditions".format(self.device.name, json_data['did'], json_data['ts'], len(json_data['conditions'])))
-        self.logger.threaddebug("{}".format(json_data))
+
+    def udp_error(self, status):
+        stateList = [
+            { 'key':'status',   'value': status},
+        ]
+        self.stateCache.updateStates(self.device, stateList)
+        self.stateCache.updateImage(self.device, indigo.kStateImageSel.SensorTripped)
+
+
+    def udp_process(self, json_data):
+
+        self.did = json_data['did']
+        self.ts = json_data['ts']
+        self.last_broadcast = time.time()
+        self.gap_limit = kBroadcastGap
+        if self.last_broadcast_ts and json_data['ts'] - self.last_broadcast_ts > kBroadcastGap:
+            self.logger.debug(u"%s: Broadcasts resumed after %s seconds", self.device.name, json_data['ts'] - self.last_broadcast_ts)
+        self.last_broadcast_ts = json_data['ts']
+        
+        self.logger.threaddebug(u"%s: udp_process: did = %s, ts = %s, %d conditions", self.device.name, json_data['did'], json_data['ts'], len(json_data['conditions']))
+        self.logger.threaddebug("%s", json_data)
 
         time_string = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime(float(json_data['ts'])))
 
@@ -163,53 +233,45 @@ class WeatherLink(object):
             { 'key':'did',      'value':  json_data['did']},
             { 'key':'timestamp','value':  time_string}
         ]
-        self.device.updateStatesOnServer(stateList)
+        self.stateCache.updateStates(self.device, stateList)
                    
         return json_data['conditions']
         
 
-    def http_poll(self):
-        
+    def start_poll(self):
+        # Runs on the concurrent thread, before http_poll is handed to a worker
+
         self.logger.info(u"{}: Polling WeatherLink Live".format(self.device.name))
         
         self.calculateNextPollTime(False)  # Calculate next polling time taking polling rounding into account
+        self.http_pending = True
 
-        url = "http://{}:{}/v1/current_conditions".format(self.address, self.http_port)
-        try:
-            response = requests.get(url, timeout=3.0)
-        except requests.exceptions.RequestException as err:
-            self.logger.error(u"{}: http_poll RequestException: {}".format(self.device.name, err))
-            stateList = [
-                { 'key':'status',   'value': 'HTTP Error'},
-            ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-            return
 
-        try:
-            json_data = response.json()
-        except Exception as err:
-            self.logger.error(u"{}: http_poll JSON decode error: {}".format(self.device.name, err))
-            stateList = [
-                { 'key':'status',   'value': 'JSON Error'},
-            ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-            return
+    def http_poll(self):
+        return self.client.http_poll()
 
-        self.logger.threaddebug("{}".format(response.text))
-            
-        if json_data['error']:
-            self.logger.error(u"{}: http_poll Bad return code: {}".format(self.device.name, json_data['error']))
+
+    def http_poll_complete(self, result):
+        # Runs on the concurrent thread, returns the conditions to process
+        
+        self.http_pending = False
+        if self.device.pluginProps['enableUDP'] and time.time() > self.lease_expires:
+            self.next_udp_start = time.time() + 2.0     # no broadcasts yet, give the WLL a moment before asking
+        status, json_data = result or ('Error', None)
+
+        if status != 'OK':
             stateList = [
-                { 'key':'status',   'value': 'Server Error'},
+                { 'key':'status',   'value': status},
             ]
-            self.device.updateStatesOnServer(stateList)
-            self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
+            self.stateCache.updateStates(self.device, stateList)
+            self.stateCache.updateImage(self.device, indigo.kStateImageSel.SensorTripped)
             return
 
-        self.logger.debug(u"{}: http_poll success: did = {}, ts = {}, {} conditions".format(self.device.name, json_data['data']['did'], json_data['data']['ts'], len(json_data['data']['conditions'])))
-        self.logger.threaddebug("{}".format(json_data))
+        self.did = json_data['data']['did']
+        self.ts = json_data['data']['ts']
+
+        self.logger.debug(u"%s: http_poll success: did = %s, ts = %s, %d conditions", self.device.name, json_data['data']['did'], json_data['data']['ts'], len(json_data['data']['conditions']))
+        self.logger.threaddebug("%s", json_data)
 
         time_string = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime(float(json_data['data']['ts'])))
 
@@ -218,8 +280,24 @@ class WeatherLink(object):
             { 'key':'did',      'value':  json_data['data']['did']},
             { 'key':'timestamp','value':  time_string}
         ]
-        self.device.updateStatesOnServer(stateList)
-        self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
+        self.stateCache.updateStates(self.device, stateList)
+        self.stateCache.updateImage(self.device, indigo.kStateImageSel.SensorOn)
 
         return json_data['data']['conditions']
 
+
+    def update_perf_states(self, perfStats):
+        # Optional device states, summarizing this base station's entries in the plugin's PerfStats
+
+        def last_ms(stage):
+            timer = perfStats.timer(stage, self.device.name)
+            return round(timer.last * 1000.0, 1) if timer else 0.0
+
+        stateList = [
+            { 'key':'perf_packets',         'value': perfStats.counter('packets', self.device.name)},
+            { 'key':'perf_decode_errors',   'value': perfStats.counter('decode_errors', self.device.name)},
+            { 'key':'perf_http_poll_ms',    'value': last_ms('http_poll')},
+            { 'key':'perf_convert_ms',      'value': last_ms('convert')},
+            { 'key':'perf_push_ms',         'value': last_ms('push')}
+        ]
+        self.stateCache.updateStates(self.device, stateList)
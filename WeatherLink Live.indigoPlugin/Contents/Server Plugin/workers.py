@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import threading
+import Queue
+import logging
+
+################################################################################
+#
+#   Small fixed-size thread pool for blocking network requests.  Jobs run on the
+#   worker threads, their completion callbacks run on whichever thread calls
+#   processResults() (the plugin's concurrent thread), so device and state
+#   handling stays single threaded.
+#
+################################################################################
+
+class WorkerPool(object):
+
+    def __init__(self, name, size, notify):
+        self.logger = logging.getLogger("Plugin.WorkerPool")
+        self.name = name
+        self.notify = notify        # called after each job completes, to wake the concurrent thread
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.worker, name="{}-{}".format(name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, callback, *args):
+        self.jobs.put((function, args, callback))
+
+    def worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            function, args, callback = job
+            try:
+                result = function(*args)
+            except Exception as err:
+                self.logger.exception(u"{} worker error: {}".format(self.name, err))
+                result = None
+
+            self.results.put((callback, result))
+            self.notify()
+
+    def processResults(self):
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                callback(result)
+            except Exception as err:
+                # one failed completion mustn't end the concurrent thread for every other device
+                self.logger.exception(u"{} completion error: {}".format(self.name, err))
+
+    def stop(self):
+        for thread in self.threads:
+            self.jobs.put(None)
@@ -10,6 +10,12 @@ import requests
 
 from datetime import datetime
 
+kUploadTimeout = 10.0       # seconds allowed for the upload request
+kBackfillAge = 7 * 24 * 60 * 60.0   # seconds an observation that couldn't be sent is kept, it's sent with its original dateutc
+kRapidTimeout = 5.0         # seconds allowed for a RapidFire request
+kMinRapidInterval = 2.5     # the WLL broadcasts every 2.5 seconds, no point sending faster
+kMaxRapidBackoff = 300.0    # longest wait between RapidFire attempts while they're failing
+
 class WU(object):
 
     def __init__(self, device):
@@ -27,11 +33,27 @@ class WU(object):
 
         self.updateFrequency = (float(self.device.pluginProps.get('updateFrequency', "10")) *  60.0)
         self.next_update = time.time()
+        self.upload_pending = False
+        self.backfill_age = kBackfillAge
+
+        URI = "/weatherstation/updateweatherstation.php"
+        self.url = "http://{}:{}{}".format(self.server_host, self.server_port, URI)
+
+        # RapidFire updates from the broadcast stream, at most one request in flight.  Packets that arrive while
+        # a request is pending aren't queued, the next request just sends whatever is newest by then.
+        self.rapid_fire = bool(self.device.pluginProps.get('rapidFire', False))
+        self.rapid_interval = max(float(self.device.pluginProps.get('rapidInterval', "5")), kMinRapidInterval)
+        self.rapid_url = "http://{}:{}{}".format(self.device.pluginProps.get('rapidHost', 'rtupdate.wunderground.com'), self.server_port, URI)
+        self.rapid_pending = False
+        self.next_rapid = 0.0
+        self.rapid_backoff = 0.0
+        self.session = requests.Session()       # keeps the connection open between RapidFire requests
 
         self.logger.debug(u"{}: PWS station_id = {}, server_host = {}, server_port = {}".format(self.device.name, self.address, self.server_host, self.server_port))
 
 
     def __del__(self):
+        self.session.close()
         stateList = [
             { 'key':'status',   'value':  "Off"},
             { 'key':'timestamp','value':  datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
@@ -40,62 +62,135 @@ class WU(object):
         self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorOff)
 
 
-    def send_update(self):
+    def start_update(self, readings):
+        # Runs on the concurrent thread, returns the data for send_update.  readings are from ConditionSnapshot, in US units.
 
         self.logger.info(u"{}: Sending Update".format(self.device.name))
 
         self.next_update = time.time() + self.updateFrequency
+        self.upload_pending = True
 
-        URI = "/weatherstation/updateweatherstation.php"
-        url = "http://{}:{}{}".format(self.server_host, self.server_port, URI)
-        iss_device = indigo.devices[self.iss_device]
-        baro_device = indigo.devices[self.baro_device]
-        data = {
+        data = self.base_data(readings)
+        data.update({
+            'windspeedmph': readings['wind_speed_avg_last_10_min'],
+            'winddir': readings['wind_dir_scalar_avg_last_10_min'],
+
+            'windgustmph': readings['wind_speed_hi_last_10_min'],
+            'windgustdir': readings['wind_dir_at_hi_speed_last_10_min'],
+        })
+        
+        self.logger.debug(u"%s: WU upload data = %s", self.device.name, data)
+
+        return data
+
+
+    def base_data(self, readings):
+        return {
             'ID': self.address,
             'PASSWORD': self.password,
             'softwaretype': 'Indigo WeatherLink Live', 
             'action':'updateraw',
             'dateutc': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
         
-            'tempf': float(iss_device.states['temp']),
-            'dewptf': float(iss_device.states['dew_point']),
+            'tempf': readings['temp'],
+            'dewptf': readings['dew_point'],
 
-            'baromin': float(baro_device.states['bar_sea_level']),
-            'humidity': float(iss_device.states['hum']),
+            'baromin': readings['bar_sea_level'],
+            'humidity': readings['hum'],
 
-            'rainin': float(iss_device.states['rain_60_min']),
-            'dailyrainin': float(iss_device.states['rainfall_daily']),
+            'rainin': readings['rain_60_min'],
+            'dailyrainin': readings['rainfall_daily'],
+        }
 
-            'windspeedmph': float(iss_device.states['wind_speed_avg_last_10_min']),
-            'winddir': float(iss_device.states['wind_dir_scalar_avg_last_10_min']),
 
-            'windgustmph': float(iss_device.states['wind_speed_hi_last_10_min']),
-            'windgustdir': float(iss_device.states['wind_dir_at_hi_speed_last_10_min']),
-        }
-        
-        self.logger.debug(u"{}: WU upload data = {}".format(self.device.name, data))
-            
-        try:            
-           r = requests.get(url, params=data)
+    def send_update(self, data):
+        # Runs on an upload worker thread, returns the resulting status
+
+        try:
+            r = requests.get(self.url, params=data, timeout=kUploadTimeout)
         except Exception as err:
             self.logger.error(u"{}: send_update error: {}".format(self.device.name, err))
-            status = "Request Error"
-            stateImage = indigo.kStateImageSel.SensorTripped
+            return "Request Error"
+
+        if r.status_code >= 500:
+            self.logger.error(u"{}: send_update server error: {}".format(self.device.name, r.status_code))
+            return "Server Error"
+
+        if not r.text.find('success') >= 0:
+            self.logger.error(u"{}: send_update error: {}".format(self.device.name, r.text))
+            return "Data Error"
+
+        self.logger.debug(u"%s: send_update complete", self.device.name)
+        return "OK"
+
+
+    def send_complete(self, status):
+        # Runs on the concurrent thread
+
+        self.upload_pending = False
+        if status == "OK":
+            stateImage = indigo.kStateImageSel.SensorOn
         else:
-            if not r.text.find('success') >= 0:
-                self.logger.error(u"{}: send_update error: {}".format(self.device.name, r.text))
-                status = "Data Error"
-                stateImage = indigo.kStateImageSel.SensorTripped
-            else:
-                self.logger.debug(u"{}: send_update complete".format(self.device.name))
-                status = "OK"
-                stateImage = indigo.kStateImageSel.SensorOn
+            stateImage = indigo.kStateImageSel.SensorTripped
 
         stateList = [
-            { 'key':'status',   'value':  status},
+            { 'key':'status',   'value':  status or "Request Error"},
             { 'key':'timestamp','value':  datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
         ]
         self.device.updateStatesOnServer(stateList)
         self.device.updateStateImageOnServer(stateImage)
 
-        
\ No newline at end of file
+        
+
+
+    def start_rapid(self, readings):
+        # Runs on the concurrent thread, returns the data for send_rapid
+
+        self.rapid_pending = True
+        data = self.base_data(readings)
+        data.update({
+            'windspeedmph': readings['wind_speed_last'],
+            'winddir': readings['wind_dir_last'],
+
+            'windgustmph': readings['wind_speed_hi_last_2_min'],
+            'windgustdir': readings['wind_dir_at_hi_speed_last_2_min'],
+
+            'realtime': 1,
+            'rtfreq': self.rapid_interval,
+        })
+        return data
+
+
+    def send_rapid(self, data):
+        # Runs on an upload worker thread, returns the resulting status
+
+        try:
+            r = self.session.get(self.rapid_url, params=data, timeout=kRapidTimeout)
+        except Exception as err:
+            self.logger.debug(u"%s: send_rapid error: %s", self.device.name, err)
+            return "Request Error"
+
+        if not r.text.find('success') >= 0:
+            self.logger.debug(u"%s: send_rapid error: %s", self.device.name, r.text)
+            return "Data Error"
+        return "OK"
+
+
+    def rapid_complete(self, status):
+        # Runs on the concurrent thread.  Device states are only touched when RapidFire starts or stops working.
+
+        self.rapid_pending = False
+        if status == "OK":
+            if self.rapid_backoff:
+                self.logger.info(u"{}: RapidFire updates resumed".format(self.device.name))
+                self.device.updateStatesOnServer([{ 'key':'status', 'value': "OK"}])
+                self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
+            self.rapid_backoff = 0.0
+            self.next_rapid = time.time() + self.rapid_interval
+        else:
+            if not self.rapid_backoff:
+                self.logger.warning(u"{}: RapidFire update failed: {}, backing off".format(self.device.name, status))
+                self.device.updateStatesOnServer([{ 'key':'status', 'value': status or "Request Error"}])
+                self.device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
+            self.rapid_backoff = min(max(self.rapid_backoff * 2.0, self.rapid_interval * 2.0), kMaxRapidBackoff)
+            self.next_rapid = time.time() + self.rapid_backoff
@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import sys
+import ast
+import json
+import socket
+import select
+import shutil
+import logging
+import argparse
+import subprocess
+
+from bench_packet import exportRevision, shutdownPlugin, kRepo, kServerPlugin, kTools
+
+################################################################################
+#
+#   Counts what the plugin's debug output costs per broadcast at the INFO log
+#   level, for the working tree and any earlier revisions:
+#
+#       python tools/bench_logging.py --rev 0e08ce6 --rev HEAD
+#
+#   The recorded packets in fixtures/ are sent over a loopback UDP socket and
+#   received and processed by the tree's own code, its UDPListener and
+#   routeBroadcast(), or its WeatherLink.udp_receive() in revisions that
+#   predate the shared listener, with a sensor device for every lsid.  For
+#   each packet it reports the debug and threaddebug calls made, the log
+#   records they created, the messages the logging module formatted, and the
+#   str/unicode .format() calls made while building debug call arguments,
+#   which is formatting paid for even when nothing is logged.
+#
+#   Indigo runs the plugin's logger at THREADDEBUG and filters in its
+#   handlers, so every debug call still creates a record.  The stub's plugin
+#   log file handler discards records unformatted, so "formatted" counts what
+#   the Event Log handler formatted, which at INFO should be nothing.
+#
+################################################################################
+
+kDebugMethods = ("debug", "threaddebug")
+
+
+def debugArgumentLines(treePath):
+    # Returns the (file, line) of every argument of a logger.debug() or logger.threaddebug() call in the tree
+
+    lines = set()
+    for name in os.listdir(treePath):
+        if not name.endswith(".py"):
+            continue
+        path = os.path.join(treePath, name)
+        with open(path) as source:
+            tree = ast.parse(source.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in kDebugMethods:
+                for argument in node.args + [keyword.value for keyword in node.keywords]:
+                    lines.update((path, child.lineno) for child in ast.walk(argument) if hasattr(child, 'lineno'))
+    return lines
+
+
+def measure(treePath, passes):
+    # Runs in the child process, returns the counts per packet
+
+    sys.path[:0] = [kTools, treePath]
+    import indigo           # the stub in this directory
+    import plugin
+    from fakewll import loadFixture, kSensorTypes
+
+    bench = plugin.Plugin("com.flyingdiver.indigoplugin.weatherlink-live", "WeatherLink Live", "bench", {"logLevel": logging.INFO})
+    bench.indigo_log_handler.stream = open(os.devnull, "w")
+    bench.startup()
+    bench.deviceStartComm(indigo.Device(1, u"WLL", "weatherlink", {"address": "127.0.0.1", "port": 80, "enableUDP": True}))
+    for deviceId, condition in enumerate(loadFixture("current_conditions.json")[0]['data']['conditions'], 2):
+        deviceType, statusState = kSensorTypes[condition['data_structure_type']]
+        bench.deviceStartComm(indigo.Device(deviceId, u"{} {}".format(deviceType, condition['lsid']), deviceType,
+                                            {"status_state": statusState}, address=str(condition['lsid'])))
+    broadcasts = [json.dumps(packet) for packet in loadFixture("broadcasts.json")]
+
+    if hasattr(bench, 'routeBroadcast'):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        bench.startListener(port)
+        listener = bench.listeners[port]
+
+        def receive():
+            select.select([listener.sock], [], [], 1.0)
+            bench.routeBroadcast(*listener.receive())
+    else:
+        link = bench.weatherlinks[1]
+        link.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        link.sock.settimeout(1.0)
+        link.sock.bind(('', 0))
+        port = link.sock.getsockname()[1]
+
+        def receive():
+            bench.processConditions(link.udp_receive())
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def sendAll():
+        for packet in broadcasts:
+            sender.sendto(packet, ("127.0.0.1", port))
+            receive()
+
+    sendAll()               # first packets add the sensors to knownDevices, which is logged once
+
+    counts = {'calls': 0, 'records': 0, 'formatted': 0, 'eager': 0}
+    argumentLines = debugArgumentLines(treePath)
+    realPaths = {}
+
+    def counted(function, counter):
+        def wrapper(*args, **kwargs):
+            counts[counter] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    for method in kDebugMethods:
+        setattr(logging.Logger, method, counted(getattr(logging.Logger, method), 'calls'))
+    logging.Logger.makeRecord = counted(logging.Logger.makeRecord, 'records')
+    logging.LogRecord.getMessage = counted(logging.LogRecord.getMessage, 'formatted')
+
+    def profile(frame, event, arg):
+        if event == 'c_call' and arg.__name__ == 'format':
+            path = frame.f_code.co_filename
+            if path not in realPaths:
+                realPaths[path] = os.path.join(treePath, os.path.basename(path))
+            if (realPaths[path], frame.f_lineno) in argumentLines:
+                counts['eager'] += 1
+
+    sys.setprofile(profile)
+    try:
+        for _ in range(passes):
+            sendAll()
+    finally:
+        sys.setprofile(None)
+
+    shutdownPlugin(bench)
+    packets = float(passes * len(broadcasts))
+    return dict((counter, count / packets) for counter, count in counts.items())
+
+
+def run(args):
+    trees = [(rev, rev) for rev in args.rev] or [("working tree", None)]
+
+    print(u"INFO log level, per packet:")
+    print(u"  {:24} {:>12} {:>12} {:>12} {:>12}".format("", "debug calls", "records", "formatted", "eager format"))
+    for label, rev in trees:
+        exported = exportRevision(rev) if rev else None
+        try:
+            treePath = os.path.join(exported or kRepo, kServerPlugin)
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", treePath,
+                                              "--passes", str(args.passes)])
+        finally:
+            if exported:
+                shutil.rmtree(exported)
+        results = json.loads(output.splitlines()[-1])
+        print(u"  {:24} {calls:12.2f} {records:12.2f} {formatted:12.2f} {eager:12.2f}".format(label, **results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Debug logging cost per broadcast at the INFO log level")
+    parser.add_argument("--rev", action="append", default=[], help="git revision to measure, repeat to compare (default: the working tree)")
+    parser.add_argument("--passes", type=int, default=10, help="passes over the recorded broadcasts (default 10)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(os.path.abspath(args.child), args.passes)))
+    else:
+        run(args)
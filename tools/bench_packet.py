@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import argparse
+import tempfile
+import subprocess
+
+kTools = os.path.dirname(os.path.abspath(__file__))
+kRepo = os.path.normpath(os.path.join(kTools, os.pardir))
+kServerPlugin = os.path.join("WeatherLink Live.indigoPlugin", "Contents", "Server Plugin")
+
+################################################################################
+#
+#   Micro-benchmark of the per-packet cost of decoding and converting the
+#   recorded payloads in fixtures/, for the working tree and any earlier
+#   revisions, so a change to the conversion or decode path can be compared
+#   with what came before it:
+#
+#       python tools/bench_packet.py --rev 0e08ce6 --rev HEAD
+#
+#   Each tree is measured in its own process.  Conversion is timed with the
+#   tree's sensorDictToRecord(), or sensorDictToList() in revisions that
+#   predate StateRecords, and decoding with its decoder module.  Revisions
+#   that predate the decoder are timed on the path they used: requests'
+#   Response.json() for HTTP polls and json.loads() of the decoded UTF-8
+#   string for broadcasts.
+#
+#   Memory is reported as the bytes each converted condition allocates: the
+#   sys.getsizeof() of every object reachable from the converted record or
+#   state list that isn't shared with a second conversion of the same
+#   condition, so the input's keys and values, constants and cached ints
+#   aren't counted.
+#
+################################################################################
+
+kUnits = {
+    "imperial": {},
+    "metric":   {"units_temperature": "C", "units_barometric_pressure": "HP", "units_wind": "KPH"},
+}
+
+
+def objectGraph(obj, objects):
+    # Adds obj and everything reachable from it through containers and __slots__ to objects, indexed by id
+
+    if id(obj) in objects:
+        return
+    objects[id(obj)] = obj
+    if isinstance(obj, dict):
+        children = obj.keys() + obj.values()
+    elif isinstance(obj, (list, tuple)):
+        children = obj
+    else:
+        children = [getattr(obj, name) for name in getattr(type(obj), '__slots__', ()) if hasattr(obj, name)]
+        if hasattr(obj, '__dict__'):
+            children.append(obj.__dict__)
+    for child in children:
+        objectGraph(child, objects)
+
+
+def allocatedBytes(convert, condition):
+    shared = {}
+    objectGraph(convert(condition), shared)
+    converted = {}
+    objectGraph(convert(condition), converted)
+    return sum(sys.getsizeof(obj) for key, obj in converted.items() if key not in shared)
+
+
+def measure(treePath, units, number):
+    # Runs in the child process, returns microseconds per packet for each stage and bytes per converted condition
+
+    sys.path[:0] = [kTools, treePath]
+    import logging
+    import indigo           # the stub in this directory
+    import plugin
+
+    prefs = dict(kUnits[units], logLevel=logging.WARNING)
+    bench = plugin.Plugin("com.flyingdiver.indigoplugin.weatherlink-live", "WeatherLink Live", "bench", prefs)
+    bench.startup()
+    convert = getattr(bench, 'sensorDictToRecord', None) or bench.sensorDictToList
+
+    with open(os.path.join(kTools, "fixtures", "current_conditions.json")) as fixture:
+        polls = [json.dumps(poll) for poll in json.load(fixture)]
+    with open(os.path.join(kTools, "fixtures", "broadcasts.json")) as fixture:
+        broadcasts = [json.dumps(packet) for packet in json.load(fixture)]
+
+    if os.path.exists(os.path.join(treePath, "decoder.py")):
+        import decoder
+        httpDecode = udpDecode = decoder.loads
+        responses = polls
+    else:
+        import requests
+        httpDecode = requests.models.Response.json
+
+        def udpDecode(data):
+            return json.loads(data.decode("utf-8"))
+
+        # Responses as requests builds them from the WLL's reply
+        responses = []
+        for poll in polls:
+            response = requests.models.Response()
+            response.status_code = 200
+            response.headers['Content-Type'] = "application/json"
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            response._content = poll
+            responses.append(response)
+
+    pollConditions = [udpDecode(poll)['data']['conditions'] for poll in polls]
+    broadcastConditions = [udpDecode(packet)['conditions'] for packet in broadcasts]
+
+    def perPacket(function, packets):
+        def run():
+            for packet in packets:
+                function(packet)
+        return min(timeit.repeat(run, number=number, repeat=5)) / (number * len(packets)) * 1e6
+
+    def convertAll(conditions):
+        for condition in conditions:
+            convert(condition)
+
+    def bytesPerCondition(conditions):
+        conditions = [condition for packet in conditions for condition in packet]
+        return float(sum(allocatedBytes(convert, condition) for condition in conditions)) / len(conditions)
+
+    results = {
+        'http_decode':      perPacket(httpDecode, responses),
+        'http_convert':     perPacket(convertAll, pollConditions),
+        'udp_decode':       perPacket(udpDecode, broadcasts),
+        'udp_convert':      perPacket(convertAll, broadcastConditions),
+        'http_bytes':       bytesPerCondition(pollConditions),
+        'udp_bytes':        bytesPerCondition(broadcastConditions),
+    }
+    shutdownPlugin(bench)
+    return results
+
+
+def shutdownPlugin(bench):
+    # Shut down and let the worker pools' threads finish, so they aren't woken during interpreter teardown
+    bench.shutdown()
+    for pool in [getattr(bench, name, None) for name in ('httpPool', 'uploadPool')]:
+        for thread in pool.threads if pool else []:
+            thread.join(1.0)
+
+
+def exportRevision(rev):
+    # Returns a temporary directory holding the Server Plugin folder as of rev
+    directory = tempfile.mkdtemp(prefix="wll-bench-")
+    archive = subprocess.Popen(["git", "-C", kRepo, "archive", rev, kServerPlugin], stdout=subprocess.PIPE)
+    subprocess.check_call(["tar", "-x", "-C", directory], stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise RuntimeError("git archive {} failed".format(rev))
+    return directory
+
+
+def run(args):
+    trees = [(rev, rev) for rev in args.rev] or [("working tree", None)]
+
+    print(u"{} units, microseconds per packet (best of 5) and bytes allocated per converted condition:".format(args.units))
+    print(u"  {:24} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12}".format("", "http decode", "http convert", "udp decode", "udp convert",
+                                                                      "http bytes", "udp bytes"))
+    for label, rev in trees:
+        exported = exportRevision(rev) if rev else None
+        try:
+            treePath = os.path.join(exported or kRepo, kServerPlugin)
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", treePath,
+                                              "--units", args.units, "--number", str(args.number)])
+        finally:
+            if exported:
+                shutil.rmtree(exported)
+        results = json.loads(output.splitlines()[-1])
+        print(u"  {:24} {http_decode:12.1f} {http_convert:12.1f} {udp_decode:12.1f} {udp_convert:12.1f} {http_bytes:12.0f} {udp_bytes:12.0f}".format(
+            label, **results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-packet decode and conversion cost of the recorded payloads")
+    parser.add_argument("--rev", action="append", default=[], help="git revision to measure, repeat to compare (default: the working tree)")
+    parser.add_argument("--units", choices=sorted(kUnits), default="imperial", help="reporting units selected in the plugin prefs")
+    parser.add_argument("--number", type=int, default=200, help="passes over the payloads per timing run (default 200)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.units, args.number)))
+    else:
+        run(args)
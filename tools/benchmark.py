@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import threading
+
+kTools = os.path.dirname(os.path.abspath(__file__))
+kServerPlugin = os.path.join(kTools, os.pardir, "WeatherLink Live.indigoPlugin", "Contents", "Server Plugin")
+sys.path[:0] = [kTools, kServerPlugin]
+
+import indigo               # the stub in this directory
+import plugin
+from fakewll import FakeWLL, kBroadcastPort, kSensorTypes
+
+################################################################################
+#
+#   End-to-end benchmark of the plugin's hot path, without Indigo or a
+#   WeatherLink Live.  Runs the real Plugin and its concurrent thread against
+#   fake WLLs serving the recorded payloads in fixtures/, so HTTP polling,
+#   real_time leases, UDP reception, JSON decoding, routing, state conversion
+#   and the state cache are all exercised.
+#
+#   Each station gets its own loopback address, 127.0.0.1 and up (see fakewll.py
+#   for macOS), and broadcasts to the loopback broadcast address, as the WLL
+#   broadcasts to 255.255.255.255, so every shard's socket sees every station's
+#   packets as it would on a LAN.  Reports packets/sec, the latency of each broadcast from sendto()
+#   to the end of its processing, and the server calls the stub indigo module
+#   counted.  The run fails if any station's packets counter in the plugin's
+#   perfStats doesn't match the broadcasts its fake WLL sent while measuring.
+#
+#       python tools/benchmark.py --stations 4 --rate 20 --duration 30
+#
+################################################################################
+
+kStationLsidOffset = 100000     # added to every lsid per station, so the stations' sensors don't collide
+kBroadcastTarget = "127.255.255.255"
+kDrainTime = 0.5                # seconds the fakes are paused around the measuring, for packets in flight to be processed
+
+
+class BenchPlugin(plugin.Plugin):
+    # Times each broadcast against when its fake WLL sent it
+
+    def processBroadcast(self, link, json_data):
+        plugin.Plugin.processBroadcast(self, link, json_data)
+        if json_data and self.measuring:
+            sent = self.fakes[json_data['did']].sent.get(json_data['ts'])
+            if sent >= self.measuring:
+                self.latencies.append(time.time() - sent)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def run(args):
+    fakes = {}
+    for station in range(args.stations):
+        address = "127.0.0.{}".format(station + 1)
+        try:
+            fake = FakeWLL(u"001D0A7{:05d}".format(station), args.rate, args.broadcast_port, args.target,
+                           lsidOffset=station * kStationLsidOffset, address=address)
+        except socket.error as err:
+            sys.exit(u"Unable to start a fake WLL on {}: {}".format(address, err))
+        fakes[fake.did] = fake
+
+    prefs = {"logLevel": args.log_level, "shardStations": args.shard}
+    bench = BenchPlugin("com.flyingdiver.indigoplugin.weatherlink-live", "WeatherLink Live", "bench", prefs)
+    bench.fakes = fakes
+    bench.latencies = []
+    bench.measuring = None          # time measuring started, None while warming up
+    bench.startup()
+
+    deviceId = 1
+    stations = sorted(fakes.values(), key=lambda fake: fake.did)
+    for station, fake in enumerate(stations):
+        devices = [indigo.Device(deviceId, u"WLL {}".format(station), "weatherlink",
+                                 {"address": fake.address, "port": fake.port, "enableUDP": True})]
+        deviceId += 1
+        for condition in fake.polls[0]['data']['conditions']:
+            deviceType, statusState = kSensorTypes[condition['data_structure_type']]
+            devices.append(indigo.Device(deviceId, u"{} {}".format(deviceType, condition['lsid']), deviceType,
+                                         {"status_state": statusState}, address=str(condition['lsid'])))
+            deviceId += 1
+        for device in devices:
+            bench.deviceStartComm(device)
+
+    thread = threading.Thread(target=bench.runConcurrentThread, name="concurrent")
+    thread.start()
+    try:
+        # Wait for every station's first poll and real_time request, and for its broadcasts to arrive
+        deadline = time.time() + 30.0
+        while time.time() < deadline and not all(fake.realTimeCount for fake in fakes.values()):
+            time.sleep(0.1)
+        time.sleep(args.warmup)
+
+        for fake in stations:
+            fake.pause()
+        time.sleep(kDrainTime)
+        indigo.resetCalls()
+        bench.perfStats.reset()
+        sentBefore = dict((fake.did, len(fake.sent)) for fake in stations)
+        started = bench.measuring = time.time()
+        for fake in stations:
+            fake.resume()
+        time.sleep(args.duration)
+        for fake in stations:
+            fake.pause()
+        elapsed = time.time() - started
+        time.sleep(kDrainTime)
+        bench.measuring = None
+        sentByStation = [len(fake.sent) - sentBefore[fake.did] for fake in stations]
+        packetsByStation = [bench.perfStats.counter('packets', u"WLL {}".format(station)) for station in range(len(stations))]
+    finally:
+        bench.stopConcurrentThread()
+        bench.wakeLoop()
+        thread.join(5.0)
+        bench.shutdown()
+        for fake in fakes.values():
+            fake.stop()
+
+    latencies = sorted(bench.latencies)
+    processed = len(latencies)
+    sent = sum(sentByStation)
+    calls = sum(indigo.calls.values())
+    print(u"{} stations at {} broadcasts/sec each{}, {:.1f} sec".format(args.stations, args.rate, u" (sharded)" if args.shard else u"", elapsed))
+    print(u"  packets:      {} sent, {} processed, {:.1f} packets/sec".format(sent, processed, processed / elapsed))
+    print(u"  latency:      p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        percentile(latencies, 0.50) * 1000.0, percentile(latencies, 0.95) * 1000.0,
+        percentile(latencies, 0.99) * 1000.0, percentile(latencies, 1.0) * 1000.0))
+    print(u"  server calls: {} ({:.2f} per packet), {} states sent: {}".format(
+        calls, float(calls) / processed if processed else 0.0, indigo.statesSent[0],
+        u", ".join(u"{} {}".format(method, count) for method, count in sorted(indigo.calls.items()))))
+    if args.stages:
+        print(bench.perfStats.report())
+
+    mismatched = [u"WLL {}: {} sent, {} counted".format(station, sentByStation[station], packetsByStation[station])
+                  for station in range(len(stations)) if sentByStation[station] != packetsByStation[station]]
+    if mismatched:
+        sys.exit(u"FAILED, packets counted per station don't match what was sent: " + u"; ".join(mismatched))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the plugin's hot path against fake WeatherLink Lives")
+    parser.add_argument("--stations", type=int, default=1, help="fake WLLs to run (default 1)")
+    parser.add_argument("--rate", type=float, default=10.0, help="broadcasts per second from each station (default 10)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to measure for (default 10)")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds to run before measuring (default 2)")
+    parser.add_argument("--shard", action="store_true", help="run each station in its own process")
+    parser.add_argument("--stages", action="store_true", help="also print the plugin's per-stage timings")
+    parser.add_argument("--broadcast-port", type=int, default=kBroadcastPort)
+    parser.add_argument("--target", default=kBroadcastTarget, help="address the broadcasts are sent to (default {})".format(kBroadcastTarget))
+    parser.add_argument("--log-level", type=int, default=logging.WARNING)
+    run(parser.parse_args())
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import sys
+import time
+import socket
+import threading
+
+kTools = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [kTools, os.path.join(kTools, os.pardir, "WeatherLink Live.indigoPlugin", "Contents", "Server Plugin")]
+
+################################################################################
+#
+#   Fake APRS-IS server: greets, acknowledges the login with a # logresp line
+#   and records every line it receives.  Running this file checks the APRS
+#   sender's client against it: login, connection reuse, keepalives,
+#   reconnecting after the server drops the connection and backing off while
+#   it's unreachable.
+#
+#       python tools/fakeaprs.py
+#
+################################################################################
+
+class FakeAPRSIS(object):
+
+    def __init__(self):
+        self.lines = []             # lines received, login included
+        self.connections = []
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.accept, name="fakeaprs")
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error:
+                return          # closed
+            self.connections.append(conn)
+            thread = threading.Thread(target=self.serve, args=(conn,), name="fakeaprs-conn")
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        reader = conn.makefile('rb')
+        conn.sendall("# aprsc 2.1.4 fake\r\n")
+        login = reader.readline()
+        self.lines.append(login.strip())
+        conn.sendall("# logresp {} unverified, server FAKE\r\n".format(login.split()[1] if login.startswith("user ") else "?"))
+        for line in iter(reader.readline, ''):
+            self.lines.append(line.strip())
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.drop()
+
+    def drop(self):
+        # Closes every open connection from the server's side
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+
+if __name__ == '__main__':
+    import indigo           # the stub in this directory
+    import aprs
+
+    aprs.kUploadTimeout = 0.5
+    aprs.kKeepaliveInterval = 1.0
+
+    server = FakeAPRSIS()
+    client = aprs.APRSClient("check", "127.0.0.1", server.port, "user CW0001 pass -1 vers fakeaprs 1.0\r\n")
+    failures = []
+
+    def check(name, passed):
+        print(u"{:6} {}".format("ok" if passed else "FAILED", name))
+        if not passed:
+            failures.append(name)
+
+    began = time.time()
+    client.send("CW0001>APRS,TCPIP*:@first\r\n")
+    check(u"login acknowledged without a fixed sleep ({:.0f} ms)".format((time.time() - began) * 1000.0), time.time() - began < 1.0)
+    client.send("CW0001>APRS,TCPIP*:@second\r\n")
+    time.sleep(0.2)
+    check(u"second packet reuses the connection", len(server.connections) == 1 and server.lines[-1].endswith("@second"))
+
+    time.sleep(2.5)
+    check(u"keepalive sent while idle", "#keepalive" in server.lines)
+
+    server.drop()
+    time.sleep(1.0)
+    client.send("CW0001>APRS,TCPIP*:@third\r\n")
+    time.sleep(0.2)
+    check(u"reconnects after the server drops the connection", len(server.connections) == 2 and server.lines[-1].endswith("@third"))
+
+    server.close()
+    time.sleep(1.0)
+    errors = []
+    for attempt in range(2):
+        try:
+            client.send("CW0001>APRS,TCPIP*:@unsent\r\n")
+        except socket.error as err:
+            errors.append(str(err))
+    check(u"backs off instead of reconnecting on every upload ({})".format(errors[-1] if errors else None),
+          len(errors) == 2 and "reconnect delayed" in errors[-1])
+
+    client.close()
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import copy
+import json
+import time
+import socket
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+################################################################################
+#
+#   Fake WeatherLink Live for the benchmarks, serving the recorded payloads in
+#   fixtures/.  GET /v1/current_conditions returns the next recorded response,
+#   GET /v1/real_time starts UDP broadcasts of the recorded packets at a fixed
+#   rate for the requested duration, like the real WLL does.
+#
+#   lsidOffset is added to every sensor's lsid, so several fake stations can
+#   run side by side without their sensors colliding.  Each can also be given
+#   its own loopback address (127.0.0.2 and up, which Linux answers out of the
+#   box, macOS after "sudo ifconfig lo0 alias 127.0.0.2 up"), which its HTTP
+#   server listens on and its broadcasts are sent from, like separate WLLs.
+#
+#   Broadcasts are stamped with consecutive ts values, and the time each one
+#   was sent is kept in sent{}, so a benchmark can measure how long the plugin
+#   took to process it.  pause() holds the broadcasts without ending the
+#   real_time lease, so a benchmark can let the plugin catch up before and
+#   after it measures.
+#
+################################################################################
+
+kFixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+kBroadcastPort = 22222      # the WLL's own broadcast port
+kSensorTypes = {            # sensor device type and status state for the fixtures' sensors, indexed by data_structure_type
+    1: ("issSensor", "temp"),
+    2: ("moistureSensor", "temp_1"),
+    3: ("baroSensor", "bar_sea_level"),
+    4: ("tempHumSensor", "temp_in"),
+}
+
+
+def loadFixture(name):
+    with open(os.path.join(kFixtures, name), "r") as fixture:
+        return json.load(fixture)
+
+
+class WLLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        wll = self.server.wll
+        if self.path.startswith("/v1/current_conditions"):
+            body = wll.currentConditions()
+        elif self.path.startswith("/v1/real_time"):
+            query = dict(part.split("=", 1) for part in self.path.partition("?")[2].split("&") if "=" in part)
+            body = wll.realTime(int(query.get("duration", "1200")))
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WLLServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeWLL(object):
+
+    def __init__(self, did="001D0A700002", rate=0.4, broadcastPort=kBroadcastPort, target="127.0.0.1", lsidOffset=0, address="127.0.0.1"):
+        self.did = did
+        self.address = address
+        self.rate = rate                    # broadcasts per second, the WLL sends one every 2.5 seconds
+        self.broadcastPort = broadcastPort
+        self.target = target
+        self.polls = loadFixture("current_conditions.json")
+        self.broadcasts = loadFixture("broadcasts.json")
+        for condition in [condition for poll in self.polls for condition in poll['data']['conditions']] + \
+                         [condition for packet in self.broadcasts for condition in packet['conditions']]:
+            condition['lsid'] += lsidOffset
+        self.pollCount = 0
+        self.realTimeCount = 0
+        self.sent = {}                      # time each broadcast was sent, indexed by its ts
+        self.lock = threading.Lock()
+        self.leaseExpires = 0.0
+        self.broadcaster = None
+        self.stopped = False
+        self.paused = False
+
+        self.server = WLLServer((address, 0), WLLHandler)
+        self.server.wll = self
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever, name="fakewll-{}".format(self.port))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def currentConditions(self):
+        with self.lock:
+            response = copy.deepcopy(self.polls[self.pollCount % len(self.polls)])
+            self.pollCount += 1
+        response['data']['did'] = self.did
+        response['data']['ts'] = int(time.time())
+        return response
+
+    def realTime(self, duration):
+        with self.lock:
+            self.realTimeCount += 1
+            self.leaseExpires = time.time() + duration
+            if not self.broadcaster:
+                self.broadcaster = threading.Thread(target=self.broadcast, name="fakewll-udp-{}".format(self.port))
+                self.broadcaster.daemon = True
+                self.broadcaster.start()
+        return {"data": {"broadcast_port": self.broadcastPort, "duration": duration}, "error": None}
+
+    def broadcast(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind((self.address, 0))
+        interval = 1.0 / self.rate
+        ts = int(time.time())
+        nextSend = time.time()
+        index = 0
+        while True:
+            with self.lock:
+                if self.stopped or time.time() >= self.leaseExpires:
+                    self.broadcaster = None
+                    break
+            if self.paused:
+                time.sleep(0.01)
+                nextSend = time.time()
+                continue
+            packet = self.broadcasts[index % len(self.broadcasts)]
+            packet = {"did": self.did, "ts": ts + index, "conditions": packet['conditions']}
+            data = json.dumps(packet)
+            self.sent[packet['ts']] = time.time()
+            sock.sendto(data, (self.target, self.broadcastPort))
+            index += 1
+
+            nextSend += interval
+            delay = nextSend - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the recorded WLL payloads, for trying the plugin without a WeatherLink Live")
+    parser.add_argument("--did", default="001D0A700002")
+    parser.add_argument("--rate", type=float, default=0.4, help="broadcasts per second (default 0.4, as the WLL)")
+    parser.add_argument("--broadcast-port", type=int, default=kBroadcastPort)
+    parser.add_argument("--target", default="127.0.0.1", help="address the broadcasts are sent to")
+    parser.add_argument("--address", default="127.0.0.1", help="address to listen on and send the broadcasts from")
+    args = parser.parse_args()
+
+    wll = FakeWLL(args.did, args.rate, args.broadcast_port, args.target, address=args.address)
+    print("Fake WLL {} listening on {}:{}".format(args.did, args.address, wll.port))
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        wll.stop()
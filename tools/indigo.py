@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import time
+import logging
+import tempfile
+
+################################################################################
+#
+#   Stand-in for the indigo module, so the plugin can run outside the Indigo
+#   server for the benchmarks in this directory.  Devices keep their states
+#   locally, and every call that would go to the server is counted in
+#   calls{}, indexed by method name, and in statesSent.
+#
+################################################################################
+
+logging.THREADDEBUG = 5
+logging.addLevelName(logging.THREADDEBUG, "THREADDEBUG")
+
+def _threaddebug(self, msg, *args, **kwargs):
+    if self.isEnabledFor(logging.THREADDEBUG):
+        self._log(logging.THREADDEBUG, msg, args, **kwargs)
+
+logging.Logger.threaddebug = _threaddebug
+
+calls = {}                  # server calls made, indexed by method name
+statesSent = [0]            # states passed to updateStatesOnServer()
+
+
+def resetCalls():
+    calls.clear()
+    statesSent[0] = 0
+
+
+def _count(method):
+    calls[method] = calls.get(method, 0) + 1
+
+
+class _StateImageSel(object):
+    def __getattr__(self, name):
+        return name
+
+kStateImageSel = _StateImageSel()
+
+
+class Dict(dict):
+    pass
+
+
+class List(list):
+    pass
+
+
+class _Server(object):
+
+    def __init__(self):
+        self.installFolder = tempfile.mkdtemp(prefix="wll-indigo-")
+
+    def getInstallFolderPath(self):
+        return self.installFolder
+
+    def getLogsFolderPath(self, pluginId=None):
+        return os.path.join(self.installFolder, "Logs", pluginId or "")
+
+    def getLatitudeAndLongitude(self):
+        return (42.36, -71.06)
+
+server = _Server()
+
+
+class Device(object):
+
+    def __init__(self, deviceId, name, deviceTypeId, pluginProps, address=""):
+        self.id = deviceId
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.pluginProps = pluginProps
+        self.address = address
+        self.states = {}
+        self.lastUpdate = None      # time of the last updateStatesOnServer() call
+
+    def updateStatesOnServer(self, stateList):
+        _count('updateStatesOnServer')
+        statesSent[0] += len(stateList)
+        for state in stateList:
+            self.states[state['key']] = state['value']
+        self.lastUpdate = time.time()
+
+    def updateStateOnServer(self, key, value, **kwargs):
+        _count('updateStateOnServer')
+        statesSent[0] += 1
+        self.states[key] = value
+
+    def updateStateImageOnServer(self, image):
+        _count('updateStateImageOnServer')
+
+    def replacePluginPropsOnServer(self, pluginProps):
+        _count('replacePluginPropsOnServer')
+        self.pluginProps = pluginProps
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+
+class PluginBase(object):
+
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.stopThread = False
+        self.logger = logging.getLogger("Plugin")
+        self.logger.setLevel(logging.THREADDEBUG)
+        self.plugin_file_handler = logging.NullHandler()
+        self.indigo_log_handler = logging.StreamHandler()
+        self.logger.addHandler(self.indigo_log_handler)
+
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread
+        time.sleep(seconds)
+
+    def stopConcurrentThread(self):
+        self.stopThread = True
+
+    def deviceUpdated(self, origDev, newDev):
+        pass
+
+    def getDeviceDisplayStateId(self, device):
+        return None